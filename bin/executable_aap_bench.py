@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+aap_bench.py - Throughput benchmark for the AAP tools against a local mock
+Description:
+    Starts aap_mock.py on a free local port and runs aap_leak_check.py, get_aap_objects_to_remediate.py
+    and fix_aap_org.py against it, each as its own process in a scratch HOME and working directory,
+    reporting seconds, items/s (jobs downloaded, objects listed or templates patched), MB/s served
+    and the number of requests. aap_leak_check.py runs twice: "leak" from an empty HOME and
+    "leak-rerun" right after, with nothing new to fetch. Results are saved to a JSON file, and
+    --compare prints the speed ratio against an earlier one.
+    Expects the tools, aap_mock.py and parselog_bench.py next to it, as installed in ~/bin.
+Usage:
+    aap_bench.py [--tools leak,objects,fix] [--jobs N] [--running N] [--templates N] [--objects N]
+                 [--log-mb MB] [--hosts N] [--latency-ms MS] [--error-rate R] [--leak-every N]
+                 [--max-display-mb MB] [--seed N] [-o RESULTS] [--compare OLD] [--keep]
+    aap_bench.py -h
+Options:
+    -h, --help            show this help message and exit
+    --tools TOOLS         Comma-separated tools: leak (with leak-rerun), objects, fix
+    -o RESULTS, --output RESULTS
+                          Results file (default aap_bench-<timestamp>.json)
+    --compare OLD         Print the speedup of each tool against this earlier results file
+    --keep                Keep the scratch directory
+    The other options configure the mock, see aap_mock.py -h.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import aap_mock
+
+BIN = os.path.dirname(os.path.abspath(__file__))
+TOOLS = ("leak", "objects", "fix")
+SCRIPTS = {
+    "leak": "aap_leak_check.py",
+    "objects": "get_aap_objects_to_remediate.py",
+    "fix": "fix_aap_org.py",
+}
+
+
+def mock_stats(url):
+    with urllib.request.urlopen(url + "_stats") as response:
+        return json.load(response)
+
+
+def run_tool(label, tool, args, items, env, workdir, url):
+    """Run one tool against the mock and return its timing."""
+    before = mock_stats(url)
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, os.path.join(BIN, SCRIPTS[tool]), *args],
+        env=env,
+        cwd=workdir,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    after = mock_stats(url)
+    served = after["bytes"] - before["bytes"]
+    result = {
+        "tool": label,
+        "seconds": round(elapsed, 3),
+        "items": items,
+        "items_per_s": round(items / elapsed, 1),
+        "mb": round(served / (1024 * 1024), 1),
+        "mb_per_s": round(served / (1024 * 1024) / elapsed, 1),
+        "requests": after["requests"] - before["requests"],
+        "errors": after["errors"] - before["errors"],
+        "returncode": completed.returncode,
+    }
+    print(
+        "{tool:<12} {seconds:8.2f}s {items:>7} items {items_per_s:10.1f} items/s "
+        "{mb_per_s:8.1f} MB/s {requests:>7} requests".format(**result),
+        flush=True,
+    )
+    if completed.returncode != 0:
+        print("{} failed ({}):".format(label, completed.returncode))
+        print("\n".join(completed.stderr.splitlines()[-10:]))
+    return result
+
+
+def compare(results, oldfile):
+    with open(oldfile) as file:
+        old = {result["tool"]: result for result in json.load(file)["results"]}
+    for result in results:
+        before = old.get(result["tool"])
+        if before is None:
+            continue
+        print(
+            "{:<12} {:6.2f}x speed".format(
+                result["tool"], before["seconds"] / result["seconds"]
+            )
+        )
+
+
+def main(options):
+    tools = options.tools.split(",")
+    assert set(tools) <= set(TOOLS), "Tools must be among {}".format(",".join(TOOLS))
+
+    start = time.perf_counter()
+    server = aap_mock.serve(options)
+    url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    print(
+        "mock serving {} jobs of {:.1f} MB at {} (ready in {:.1f}s)".format(
+            len(server.aap.jobs),
+            len(server.aap.log) / (1024 * 1024),
+            url,
+            time.perf_counter() - start,
+        )
+    )
+    workdir = tempfile.mkdtemp(prefix="aap_bench.")
+    env = {
+        **os.environ,
+        "HOME": os.path.join(workdir, "home"),
+        "AAP_DEV_RW_TOKEN": "bench",
+        "BEARER_TOKEN": "bench",
+        "AAP_JOBS_URL": url + "api/v2/jobs/",
+        "AAP_BASE_URL": url + "api/v2/",
+    }
+    os.makedirs(env["HOME"])
+    templates = len(server.aap.objects["job_templates"])
+    results = []
+    try:
+        if "leak" in tools:
+            jobs = len(server.aap.jobs)
+            results.append(run_tool("leak", "leak", [], jobs, env, workdir, url))
+            results.append(
+                run_tool("leak-rerun", "leak", [], options.running, env, workdir, url)
+            )
+        if "objects" in tools:
+            objects = sum(
+                len(server.aap.objects[object_type])
+                for object_type in aap_mock.OBJECT_TYPES
+            )
+            results.append(
+                run_tool("objects", "objects", [], objects, env, workdir, url)
+            )
+        if "fix" in tools:
+            args = [
+                "--template_ids",
+                *(str(number) for number in range(1, templates + 1)),
+            ]
+            results.append(run_tool("fix", "fix", args, templates, env, workdir, url))
+    finally:
+        server.shutdown()
+        if options.keep:
+            print("kept {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    output = options.output or "aap_bench-{}.json".format(
+        time.strftime("%Y%m%d-%H%M%S")
+    )
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "config": {
+                    "jobs": options.jobs,
+                    "running": options.running,
+                    "templates": options.templates,
+                    "objects": options.objects,
+                    "log_mb": options.log_mb,
+                    "hosts": options.hosts,
+                    "latency_ms": options.latency_ms,
+                    "error_rate": options.error_rate,
+                    "leak_every": options.leak_every,
+                    "max_display_mb": options.max_display_mb,
+                    "seed": options.seed,
+                    "environment": {
+                        name: value
+                        for name, value in os.environ.items()
+                        if name.startswith("AAP_") and "TOKEN" not in name
+                    },
+                },
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print("results saved to {}".format(output))
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the AAP tools against a local mock"
+    )
+    parser.add_argument(
+        "--tools",
+        default=",".join(TOOLS),
+        help="Comma-separated tools: leak, objects, fix",
+    )
+    aap_mock.add_arguments(parser)
+    parser.set_defaults(port=0)
+    parser.add_argument("-o", "--output", help="Results file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the scratch directory"
+    )
+
+    options = parser.parse_args()
+
+    main(options)
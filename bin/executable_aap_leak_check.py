@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 
 import csv
+import gzip
+import hashlib
+import heapq
 import json
 import logging
 import os
+import queue
+import re
 import subprocess
 import sys
 import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import partial
 
 import requests
+from requests.adapters import HTTPAdapter
 from urllib3.exceptions import InsecureRequestWarning
+from urllib3.util.retry import Retry
+
+import secret_scan
 
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
@@ -32,12 +46,89 @@ NOW = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
 if (ansible_api_token := os.getenv("AAP_DEV_RW_TOKEN")) is None:
     logging.error("Environment variable AAP_DEV_RW_TOKEN is not set.")
     sys.exit(1)
-ansible_api_url = "https://mihdqdevc01.marriott.com/api/v2/jobs/"
+# AAP_JOBS_URL points it elsewhere, e.g. at aap_mock.py
+ansible_api_url = os.getenv(
+    "AAP_JOBS_URL", "https://mihdqdevc01.marriott.com/api/v2/jobs/"
+)
 output_folder = f"{HOME}/sandbox/aap_job_outputs/data"
 trufflehog_log = f"{HOME}/sandbox/aap_job_outputs/trufflehog.log"
 trufflehog_out = f"{HOME}/sandbox/aap_job_outputs/trufflehog_output.json"
 trufflehog_err = f"{HOME}/sandbox/aap_job_outputs/trufflehog_error.txt"
 csv_output = f"{HOME}/sandbox/aap_job_outputs/security_concerns.csv"
+# TruffleHog runs as trufflehog_shards processes, each over a share of the
+# logs of about equal total bytes (hard-linked into shard_folder) and with
+# trufflehog_concurrency workers of its own; shard timings go to
+# trufflehog_shards_out
+trufflehog_shards = int(os.getenv("AAP_TRUFFLEHOG_SHARDS", "0")) or os.cpu_count()
+trufflehog_concurrency = int(os.getenv("AAP_TRUFFLEHOG_CONCURRENCY", "0")) or max(
+    1, os.cpu_count() // trufflehog_shards
+)
+trufflehog_shards_out = f"{HOME}/sandbox/aap_job_outputs/trufflehog_shards.json"
+shard_folder = f"{HOME}/sandbox/aap_job_outputs/shards"
+# High-water mark of the last successful sync, so each run only lists the jobs
+# that finished since. AAP_SYNC_SINCE (an ISO timestamp) bounds the first run.
+sync_state_file = f"{HOME}/sandbox/aap_job_outputs/sync_state.json"
+job_fields = ("id", "name", "started", "finished", "job_template")
+jobs_page_size = 200
+
+# Download tuning: parallel downloads, and retries of connection errors and
+# 429/5xx responses, waiting download_backoff * 2**n seconds between tries
+download_workers = int(os.getenv("AAP_DOWNLOAD_WORKERS", "8"))
+download_retries = int(os.getenv("AAP_DOWNLOAD_RETRIES", "5"))
+download_backoff = float(os.getenv("AAP_DOWNLOAD_BACKOFF", "1"))
+download_timeout = (10, 300)
+download_chunk_bytes = 1 << 20
+# Job stdouts are streamed into job_<id>.txt.gz (or .zst, or plain .txt with
+# "none"); trufflehog and parselog.py read all three
+stdout_compression = os.getenv("AAP_STDOUT_COMPRESSION", "gz")
+stdout_suffixes = {"gz": ".gz", "zst": ".zst", "none": ""}
+thread_local = threading.local()
+# Jobs still running are listed too and their stdout fetched as far as it
+# goes; partial_jobs (kept in the sync state) has the number of lines fetched
+# per job, and later runs fetch only the lines after it (start_line) and
+# append them, until the job finishes
+# AAP only honours start_line for format=json (txt and txt_download always
+# return the whole stdout); content_format=ansi gets the raw text, whose ANSI
+# codes are stripped like txt_download does. Above its display limit AAP
+# answers with a stdout_too_large placeholder instead, and the whole stdout is
+# downloaded again.
+partial_jobs = {}
+partial_lock = threading.Lock()
+stdout_too_large = "Standard Output too large to display"
+ansi_escape = re.compile(r"\x1b[^m]*m")
+# Secret scanner: "builtin" (secret_scan.py, next to this script in ~/bin) or
+# "trufflehog"; the builtin one scans on scan_workers processes and keeps each
+# file's findings in scan_cache_file, so only new or changed logs are scanned.
+# With it, listing, downloads and scans run as a pipeline: each log is scanned
+# as soon as it is downloaded, through queues of at most pipeline_depth items
+# per worker, and findings are written to the CSV as they come in.
+scanner = os.getenv("AAP_SCANNER", "builtin")
+scan_workers = int(os.getenv("AAP_SCAN_WORKERS", "0")) or os.cpu_count()
+scan_cache_file = f"{HOME}/sandbox/aap_job_outputs/scan_cache.json"
+# Every finding of every run, keyed by (detector, secret hash, job id, job
+# template); the CSV only lists findings whose secret was not seen in the same
+# template by an earlier run. Rows are inserted findings_batch at a time.
+findings_db = f"{HOME}/sandbox/aap_job_outputs/findings.db"
+findings_batch = 1000
+pipeline_depth = 2
+
+if scanner not in ("builtin", "trufflehog"):
+    logging.error("AAP_SCANNER must be builtin or trufflehog.")
+    sys.exit(1)
+if stdout_compression not in stdout_suffixes:
+    logging.error(
+        f"AAP_STDOUT_COMPRESSION must be one of {', '.join(stdout_suffixes)}."
+    )
+    sys.exit(1)
+if stdout_compression == "zst":
+    try:
+        from compression import zstd  # Python 3.14+
+    except ImportError:
+        try:
+            import zstandard as zstd
+        except ImportError:
+            logging.error("AAP_STDOUT_COMPRESSION=zst needs the zstandard package.")
+            sys.exit(1)
 
 # Create output folder if it doesn't exist
 os.makedirs(output_folder, exist_ok=True)
@@ -48,146 +139,711 @@ os.makedirs(archive_folder, exist_ok=True)
 for file in [
     trufflehog_out,
     trufflehog_err,
+    trufflehog_shards_out,
     csv_output,
     "aap_leak_check.log",
 ]:
     if os.path.exists(file):
-        date_filename = f"{"".join(file.split('.')[0:-1])}_{NOW}.{file.split('.')[-1]}"
-        shutil.move(file, os.path.join(archive_folder, date_filename))
+        name, extension = os.path.splitext(os.path.basename(file))
+        shutil.move(file, os.path.join(archive_folder, f"{name}_{NOW}{extension}"))
         logging.info(f"Moved {file} to archive folder.")
 
-# Function to download job stdout
+
+# One keep-alive session per download thread, so each thread reuses its
+# TLS connection instead of opening a new one per job
+def get_session():
+    session = getattr(thread_local, "session", None)
+    if session is None:
+        retry = Retry(
+            total=download_retries,
+            backoff_factor=download_backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=1)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(
+            {
+                "Authorization": f"Bearer {ansible_api_token}",
+                "Content-Type": "application/json",
+            }
+        )
+        session.verify = False
+        thread_local.session = session
+    return session
+
+
+def open_stdout_file(path):
+    if stdout_compression == "zst":
+        return zstd.open(path, "wb")
+    if stdout_compression == "gz":
+        return gzip.open(path, "wb", compresslevel=6)
+    return open(path, "wb")
+
+
+def job_stdout_path(job_id):
+    for suffix in stdout_suffixes.values():
+        path = os.path.join(output_folder, f"job_{job_id}.txt{suffix}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def log_failed_download(job_id, response):
+    logging.error(f"Failed to download stdout for job {job_id}")
+    logging.error(f"Response: {response.text}")
+    logging.error(f"Status code: {response.status_code}")
+
+
+# Function to write a format=json stdout range to path, returns the line the
+# next range starts at, or None if AAP sent its too large placeholder
+def write_stdout_range(data, running, path):
+    content = data["content"]
+    if content.startswith(stdout_too_large):
+        return None
+    end = data["range"]["end"]
+    if running and content and not content.endswith("\n"):
+        # Keep a line still being written for the next run
+        if "\n" in content:
+            content = content[: content.rfind("\n") + 1]
+            end -= 1
+        else:
+            content = ""
+            end = data["range"]["start"]
+    with open_stdout_file(path) as file:
+        file.write(ansi_escape.sub("", content).encode())
+    return end
+
+
+# Function to download job stdout, returns the stdout file or None if the
+# download failed
+# The body is streamed to disk a chunk at a time (a line range of a running
+# job comes as one JSON body) and only renamed into place
+# (or appended, for a job fetched before while it was running) once complete,
+# so a failed download never looks like a finished one
 def download_job_stdout(job_data):
     job_id = job_data.get("id")
     if not job_id:
         logging.error(f"Job ID is missing for job data: {job_data}")
-        return
-    logging.info(f"Processing job {job_id} - {job_data['name']} started at {job_data['started']}")
-    if os.path.exists(
-        os.path.join(output_folder, f"job_{job_id}.txt")
-    ):
+        return None
+    logging.info(
+        f"Processing job {job_id} - {job_data['name']} started at {job_data['started']}"
+    )
+    running = not job_data.get("finished")
+    outputfilepath = os.path.join(
+        output_folder, f"job_{job_id}.txt{stdout_suffixes[stdout_compression]}"
+    )
+    with partial_lock:
+        start_line = partial_jobs.get(job_id)
+    existing = job_stdout_path(job_id)
+    if existing and start_line is None and not running:
         logging.info(f"Job {job_id} stdout already exists, skipping download.")
-        return
-    logging.info(f"Downloading stdout for job {job_id}")
-    url = f"{ansible_api_url}{job_id}/stdout/?format=txt_download"
-    headers = {
-        "Authorization": f"Bearer {ansible_api_token}",
-        "Content-Type": "application/json",
-    }
-    response = requests.get(url, headers=headers, verify=False)
-    if response.status_code == 200:
-        outputfilepath = os.path.join(output_folder, f"job_{job_id}.txt")
-        with open(outputfilepath, "w") as file:
-            file.write(response.text)
-        logging.info(
-            f"Downloaded stdout for job {job_id} and wrote to {outputfilepath}"
+        return existing
+    if existing != outputfilepath:
+        # Only a file in the current compression can be appended to
+        start_line = None
+    url = f"{ansible_api_url}{job_id}/stdout/"
+    partfilepath = f"{outputfilepath}.part"
+    next_line = None
+    try:
+        if start_line is not None or running:
+            logging.info(
+                f"Downloading stdout for job {job_id} from line {start_line or 0}"
+            )
+            response = get_session().get(
+                url,
+                params={
+                    "format": "json",
+                    "content_format": "ansi",
+                    "start_line": start_line or 0,
+                },
+                timeout=download_timeout,
+            )
+            if response.status_code != 200:
+                log_failed_download(job_id, response)
+                return None
+            next_line = write_stdout_range(response.json(), running, partfilepath)
+            if next_line is None:
+                logging.info(
+                    f"Job {job_id} stdout is too large for line ranges, downloading all of it"
+                )
+                start_line = None
+        if next_line is None:
+            logging.info(f"Downloading stdout for job {job_id}")
+            next_line = 0
+            with get_session().get(
+                url,
+                params={"format": "txt_download"},
+                timeout=download_timeout,
+                stream=True,
+            ) as response:
+                if response.status_code != 200:
+                    log_failed_download(job_id, response)
+                    return None
+                with open_stdout_file(partfilepath) as file:
+                    tail = b""
+                    for chunk in response.iter_content(download_chunk_bytes):
+                        if running:
+                            # Keep a line still being written for the next run
+                            complete, newline, partial = (tail + chunk).rpartition(
+                                b"\n"
+                            )
+                            tail = partial
+                            if not newline:
+                                continue
+                            chunk = complete + newline
+                        next_line += chunk.count(b"\n")
+                        file.write(chunk)
+    except requests.exceptions.RequestException as e:
+        logging.error(
+            f"Failed to download stdout for job {job_id}: {e.__class__.__name__} - {e}"
         )
+        if os.path.exists(partfilepath):
+            os.remove(partfilepath)
+        return None
+    if start_line is None:
+        os.replace(partfilepath, outputfilepath)
     else:
-        logging.error(f"Failed to download stdout for job {job_id}")
-        logging.error(f"Response: {response.text}")
-        logging.error(f"Status code: {response.status_code}")
-        sys.exit(1)
+        # gzip members and zstd frames can be concatenated
+        with open(outputfilepath, "ab") as file, open(partfilepath, "rb") as part:
+            shutil.copyfileobj(part, file)
+        os.remove(partfilepath)
+    with partial_lock:
+        if running:
+            partial_jobs[job_id] = next_line
+        else:
+            partial_jobs.pop(job_id, None)
+    logging.info(f"Downloaded stdout for job {job_id} and wrote to {outputfilepath}")
+    return outputfilepath
+
+
+# Download job stdouts on download_workers threads, returns the failed job ids
+def download_jobs(job_data_objects):
+    failed = []
+    with ThreadPoolExecutor(max_workers=download_workers) as pool:
+        futures = {
+            pool.submit(download_job_stdout, job_data): job_data.get("id")
+            for job_data in job_data_objects
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                path = future.result()
+            except Exception as e:  # e.g. an OSError writing the file
+                logging.error(
+                    f"Failed to download stdout for job {futures[future]}: "
+                    f"{e.__class__.__name__} - {e}"
+                )
+                path = None
+            if not path:
+                failed.append(futures[future])
+            if done % 100 == 0:
+                logging.info(f"Processed {done}/{len(futures)} jobs")
+    return failed
 
 
-# Function to run TruffleHog
-def run_trufflehog():
-    results = subprocess.run(
+# Function to turn a TruffleHog result into a finding shaped like secret_scan.py's
+def trufflehog_finding(result):
+    filesystem = result.get("SourceMetadata", {}).get("Data", {}).get("Filesystem", {})
+    detector = result.get("DetectorName", "Unknown")
+    line = filesystem.get("line")
+    raw = result.get("Raw", "")
+    redacted = result.get("Redacted") or secret_scan.redact(raw)
+    return {
+        "path": filesystem.get("file", ""),
+        "line": line,
+        "detector": detector,
+        "redacted": redacted,
+        "raw_sha256": hashlib.sha256(raw.encode()).hexdigest(),
+        "message": f"{detector} secret found on line {line}: {redacted}",
+    }
+
+
+# Function to split files into shards of about equal total bytes, placing
+# each file, biggest first, in the shard with the fewest bytes so far
+def shard_files(files, shards):
+    heap = [(0, number, []) for number in range(shards)]
+    for path in sorted(files, key=os.path.getsize, reverse=True):
+        size, number, shard = heapq.heappop(heap)
+        shard.append(path)
+        heapq.heappush(heap, (size + os.path.getsize(path), number, shard))
+    return [shard for _, _, shard in sorted(heap, key=lambda item: item[1]) if shard]
+
+
+# Function to run TruffleHog over one shard, reading its results (one JSON
+# object per line) from a pipe as they come and writing each to writer;
+# returns the shard's timing
+def run_trufflehog_shard(number, files, writer, lock, log_file):
+    shard_dir = os.path.join(shard_folder, str(number))
+    os.makedirs(shard_dir)
+    # Logs in different folders can share a name, so each link gets its index
+    links = {}
+    for index, path in enumerate(files):
+        link = f"{index}_{os.path.basename(path)}"
+        os.link(path, os.path.join(shard_dir, link))
+        links[link] = path
+    started = time.monotonic()
+    findings = 0
+    process = subprocess.Popen(
         [
             "trufflehog",
             "--json",
             "--no-update",
+            f"--concurrency={trufflehog_concurrency}",
             "filesystem",
-            output_folder,
+            shard_dir,
         ],
-        capture_output=True,
+        stdout=subprocess.PIPE,
+        stderr=log_file,
+        text=True,
     )
-    if results.returncode != 0:
-        logging.error(f"TruffleHog failed with return code {results.returncode}")
-        with open(trufflehog_err, "w") as err_file:
-            err_file.write(results.stderr.decode("utf-8"))
+    with process.stdout:
+        for line in process.stdout:
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(
+                    f"Skipping TruffleHog output line: {line.strip()[:200]}"
+                )
+                continue
+            finding = trufflehog_finding(result)
+            # Report the log, not its link in the shard
+            finding["path"] = links.get(
+                os.path.basename(finding["path"]), finding["path"]
+            )
+            with lock:
+                writer.add(finding)
+            findings += 1
+    returncode = process.wait()
+    shutil.rmtree(shard_dir)
+    return {
+        "shard": number,
+        "files": len(files),
+        "bytes": sum(os.path.getsize(path) for path in files),
+        "seconds": round(time.monotonic() - started, 3),
+        "findings": findings,
+        "returncode": returncode,
+    }
+
+
+# Function to run TruffleHog over the logs in shards, all at once
+def run_trufflehog(writer):
+    shards = shard_files(secret_scan.scan_files([output_folder]), trufflehog_shards)
+    shutil.rmtree(shard_folder, ignore_errors=True)
+    lock = threading.Lock()
+    try:
+        with open(trufflehog_log, "w") as log_file:
+            with ThreadPoolExecutor(max_workers=max(1, len(shards))) as pool:
+                futures = [
+                    pool.submit(
+                        run_trufflehog_shard, number, files, writer, lock, log_file
+                    )
+                    for number, files in enumerate(shards)
+                ]
+                timings = [future.result() for future in futures]
+    finally:
+        # Also gone when there were no logs or a shard failed
+        shutil.rmtree(shard_folder, ignore_errors=True)
+    with open(trufflehog_shards_out, "w") as file:
+        json.dump(timings, file, indent=4)
+    for timing in timings:
+        logging.info(
+            f"TruffleHog shard {timing['shard']}: {timing['files']} files,"
+            f" {timing['bytes']} bytes in {timing['seconds']}s, {timing['findings']} findings"
+        )
+    if failed := [timing for timing in timings if timing["returncode"] != 0]:
+        for timing in failed:
+            logging.error(
+                f"TruffleHog shard {timing['shard']} failed with return code {timing['returncode']}"
+            )
+        shutil.copyfile(trufflehog_log, trufflehog_err)
         logging.error(f"TruffleHog stderr written to {trufflehog_err}.")
         sys.exit(1)
-    if results.stdout:
-        with open(trufflehog_out, "w") as file:
-            json.dump(
-                json.loads(results.stdout.decode("utf-8")), file, indent=4
+    logging.info(f"TruffleHog found {writer.count} secrets, saved to {trufflehog_out}")
+
+
+# SQLite store of findings and the jobs (and job templates) they were found in.
+# Shared by the pipeline threads, so every method takes the lock.
+class FindingsStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started TEXT NOT NULL,
+                findings INTEGER,
+                new INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                name TEXT,
+                template INTEGER NOT NULL DEFAULT 0,
+                finished TEXT
+            );
+            CREATE TABLE IF NOT EXISTS findings (
+                detector TEXT NOT NULL,
+                secret_sha256 TEXT NOT NULL,
+                job_id INTEGER NOT NULL,
+                template INTEGER NOT NULL,
+                path TEXT,
+                line INTEGER,
+                redacted TEXT,
+                message TEXT,
+                first_run INTEGER NOT NULL,
+                last_run INTEGER NOT NULL,
+                PRIMARY KEY (detector, secret_sha256, job_id, template)
+            );
+            CREATE INDEX IF NOT EXISTS findings_secret_template
+                ON findings (detector, secret_sha256, template, first_run);
+            CREATE INDEX IF NOT EXISTS findings_first_run ON findings (first_run);
+            """
+        )
+        self.run = self.db.execute(
+            "INSERT INTO runs (started) VALUES (?)", (NOW,)
+        ).lastrowid
+        self.db.commit()
+        self.pending = []
+        self.count = 0
+        self.new = 0
+
+    def add_jobs(self, jobs):
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO jobs (id, name, template, finished) VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        job["id"],
+                        job["name"],
+                        job.get("job_template") or 0,
+                        job["finished"],
+                    )
+                    for job in jobs
+                ],
             )
-        logging.info(f"TruffleHog results saved to {trufflehog_out}")
-    else:
-        logging.warning("TruffleHog did not produce any output.")
-    if results.stderr:
-        with open(trufflehog_log, "w") as log_file:
-            log_file.write(results.stderr.decode("utf-8"))
-        logging.warning(f"TruffleHog stderr written to {trufflehog_log}.")
+            self.db.commit()
+
+    # Store a finding, returns True if its secret is new to its job template
+    def add(self, result, job_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT template FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            template = row[0] if row else 0
+            seen = self.db.execute(
+                "SELECT 1 FROM findings WHERE detector = ? AND secret_sha256 = ?"
+                " AND template = ? AND first_run < ? LIMIT 1",
+                (result["detector"], result["raw_sha256"], template, self.run),
+            ).fetchone()
+            self.pending.append(
+                (
+                    result["detector"],
+                    result["raw_sha256"],
+                    job_id,
+                    template,
+                    result["path"],
+                    result["line"],
+                    result["redacted"],
+                    result["message"],
+                    self.run,
+                    self.run,
+                )
+            )
+            if len(self.pending) >= findings_batch:
+                self.flush()
+            self.count += 1
+            self.new += seen is None
+            return seen is None
+
+    def flush(self):
+        self.db.executemany(
+            """
+            INSERT INTO findings (detector, secret_sha256, job_id, template, path, line,
+                                  redacted, message, first_run, last_run)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (detector, secret_sha256, job_id, template) DO UPDATE SET
+                path = excluded.path, line = excluded.line, last_run = excluded.last_run
+            """,
+            self.pending,
+        )
+        self.db.commit()
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.execute(
+                "UPDATE runs SET findings = ?, new = ? WHERE id = ?",
+                (self.count, self.new, self.run),
+            )
+            self.db.commit()
+            self.db.close()
+        logging.info(
+            f"Run {self.run}: {self.count} findings, {self.new} new, stored in {findings_db}"
+        )
+
+
+# Streams findings into the JSON output and the store as they come in, and
+# the ones new since the last run into the CSV, so memory does not grow with
+# the number of findings
+class FindingsWriter:
+    def __init__(self, store):
+        self.store = store
+        self.started = time.monotonic()
+        self.count = 0
+        self.csvfile = open(csv_output, "w", newline="")
+        self.writer = csv.DictWriter(self.csvfile, fieldnames=["job_id", "message"])
+        self.writer.writeheader()
+        self.jsonfile = open(trufflehog_out, "w")
+        self.jsonfile.write("[")
+
+    def add(self, result):
+        if self.count == 0:
+            logging.info(f"First finding after {time.monotonic() - self.started:.1f}s")
+        self.jsonfile.write(f"{',' if self.count else ''}\n    {json.dumps(result)}")
+        if self.store.add(result, path_job_id(result["path"]) or 0):
+            self.writer.writerow(csv_row(result))
+            self.csvfile.flush()
+        self.count += 1
+
+    def close(self):
+        self.jsonfile.write("\n]\n")
+        self.jsonfile.close()
+        self.csvfile.close()
+
+
+def path_job_id(path):
+    match = re.search(r"job_(\d+)", os.path.basename(path))
+    return int(match.group(1)) if match else None
 
 
-# Function to create CSV from TruffleHog output
-def create_csv():
+def csv_row(result):
+    job_id = path_job_id(result["path"])
+    return {"job_id": "" if job_id is None else job_id, "message": result["message"]}
+
+
+def load_sync_state():
     try:
-        with open(trufflehog_out, "r") as file:
-            trufflehog_results = json.load(file)
+        with open(sync_state_file, "r") as file:
+            state = json.load(file)
     except FileNotFoundError:
-        logging.warning("TruffleHog output file not found")
-        sys.exit(0)
-
-    with open(csv_output, "w", newline="") as csvfile:
-        fieldnames = ["job_id", "message"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for result in trufflehog_results:
-            job_id = result["path"].split("_")[1].split(".")[0]
-            message = result["message"]
-            writer.writerow({"job_id": job_id, "message": message})
-    logging.info(f"Security concerns have been saved to {csv_output}")
+        state = {"last_job_id": None, "last_finished": os.getenv("AAP_SYNC_SINCE")}
+    partial_jobs.update(
+        {int(job_id): lines for job_id, lines in state.get("partial", {}).items()}
+    )
+    return state
 
 
-def get_filtered_jobs(api_url, api_token):
-    headers = {
-        "Authorization": f"Bearer {api_token}",
-        "Content-Type": "application/json",
+# Advance the high-water mark past the finished jobs of this run, written
+# atomically so an interrupted run leaves the previous state
+def save_sync_state(state, jobs):
+    for job in jobs:
+        if not job["finished"]:
+            continue
+        if state.get("last_job_id") is None or job["id"] > state["last_job_id"]:
+            state["last_job_id"] = job["id"]
+        if (
+            state.get("last_finished") is None
+            or job["finished"] > state["last_finished"]
+        ):
+            state["last_finished"] = job["finished"]
+    state["partial"] = {
+        str(job_id): lines for job_id, lines in sorted(partial_jobs.items())
     }
-    params = {"page_size": 100}
-    jobs = []
+    state["updated"] = NOW
+    with open(f"{sync_state_file}.tmp", "w") as file:
+        json.dump(state, file, indent=4)
+    os.replace(f"{sync_state_file}.tmp", sync_state_file)
+    logging.info(
+        f"Sync state saved: last job {state['last_job_id']} finished {state['last_finished']}"
+    )
+
+
+# List the finished jobs past the sync state, then the running ones. Jobs can
+# finish out of id order, so the finished timestamp is the mark; the job id is
+# only used without one. Jobs are yielded page by page.
+def iter_filtered_jobs(api_url, state):
+    params = {
+        "page_size": jobs_page_size,
+        "order_by": "finished",
+        "finished__isnull": "false",
+    }
+    if state.get("last_finished"):
+        params["finished__gt"] = state["last_finished"]
+    elif state.get("last_job_id"):
+        params["id__gt"] = state["last_job_id"]
+    yield from iter_jobs(api_url, params)
+    yield from iter_jobs(
+        api_url, {"page_size": jobs_page_size, "order_by": "id", "status": "running"}
+    )
+
+
+def iter_jobs(api_url, params):
     page = 1
 
     while True:
         logging.info(f"Getting jobs from page {page}")
         try:
-            response = requests.get(
-                f"{api_url}?page={page}",
-                headers=headers,
-                params=params,
-                verify=False,
+            response = get_session().get(
+                api_url,
+                params={**params, "page": page},
+                timeout=download_timeout,
             )
+            response.raise_for_status()
         except requests.exceptions.RequestException as e:
             logging.error(f"Error getting job: {e.__class__.__name__} - {e}")
             sys.exit(1)
 
         data = response.json()
 
-        if "results" not in data or not data["results"]:
-            break
+        # Keep only the fields the downloads use
+        for job in data.get("results", []):
+            yield {field: job.get(field) for field in job_fields}
 
-        if page == 3:
+        if data.get("next") is None:
             break
+        page += 1
 
-        for job in data["results"]:
-            jobs.append(
-                {"id": job["id"], "name": job["name"], "started": job["started"]}
-            )
 
-        page += 1
+def get_filtered_jobs(api_url, state):
+    jobs = list(iter_filtered_jobs(api_url, state))
     logging.info(f"Total jobs: {len(jobs)}")
     return jobs
 
 
-# Main script
-job_data_objects = get_filtered_jobs(ansible_api_url, ansible_api_token)
-for job_data in job_data_objects:
-    download_job_stdout(job_data)
+# Function to list, download and scan jobs as a pipeline, writing findings to
+# writer as they come in and the jobs to its store; returns the listed jobs and
+# the failed job ids.
+# Logs already in output_folder are taken from the scan cache, or scanned.
+def run_pipeline(state, writer):
+    cache = secret_scan.ScanCache(scan_cache_file)
+    # Logs of running jobs are scanned once the rest of them is fetched
+    existing = {
+        path
+        for path in secret_scan.scan_files([output_folder])
+        if path_job_id(path) not in partial_jobs
+    }
+    jobs_queue = queue.Queue(maxsize=download_workers * pipeline_depth)
+    scan_queue = queue.Queue(maxsize=scan_workers * pipeline_depth)
+    in_flight = threading.BoundedSemaphore(scan_workers * pipeline_depth)
+    lock = threading.Lock()
+    jobs = []
+    failed = []
+    errors = []
+
+    def list_jobs():
+        try:
+            for job in iter_filtered_jobs(ansible_api_url, state):
+                jobs.append(job)
+                writer.store.add_jobs([job])
+                jobs_queue.put(job)
+        except BaseException as e:  # iter_filtered_jobs exits on errors
+            errors.append(e)
+        finally:
+            for _ in range(download_workers):
+                jobs_queue.put(None)
+
+    def download():
+        try:
+            while (job := jobs_queue.get()) is not None:
+                try:
+                    path = download_job_stdout(job)
+                except Exception as e:  # e.g. an OSError writing the file
+                    logging.error(
+                        f"Failed to download stdout for job {job.get('id')}: "
+                        f"{e.__class__.__name__} - {e}"
+                    )
+                    path = None
+                if path is None:
+                    with lock:
+                        failed.append(job.get("id"))
+                elif path not in existing:
+                    scan_queue.put(path)
+        finally:
+            scan_queue.put(None)
 
-run_trufflehog()
-create_csv()
+    def scanned(path, future):
+        try:
+            digest, findings = future.result()
+            with lock:
+                for result in cache.add(path, digest, findings):
+                    writer.add(result)
+        except Exception as e:
+            logging.error(f"Failed to scan {path}: {e.__class__.__name__} - {e}")
+            with lock:
+                errors.append(e)
+        finally:
+            in_flight.release()
+
+    threads = [threading.Thread(target=list_jobs, daemon=True)] + [
+        threading.Thread(target=download, daemon=True) for _ in range(download_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    with ProcessPoolExecutor(max_workers=scan_workers) as pool:
+
+        def scan(path):
+            in_flight.acquire()
+            pool.submit(secret_scan.hash_and_scan, path).add_done_callback(
+                partial(scanned, path)
+            )
+
+        for path in existing:
+            if (cached := cache.lookup(path)) is None:
+                scan(path)
+            else:
+                with lock:
+                    for result in cached:
+                        writer.add(result)
+        for _ in range(download_workers):
+            while (path := scan_queue.get()) is not None:
+                scan(path)
+    for thread in threads:
+        thread.join()
+    cache.save()
+    if errors:
+        logging.error(f"Pipeline failed: {errors[0]!r}")
+        sys.exit(1)
+    logging.info(f"Total jobs: {len(jobs)}, {writer.count} findings")
+    return jobs, failed
+
+
+# Main script
+sync_state = load_sync_state()
+if scanner == "trufflehog":
+    job_data_objects = get_filtered_jobs(ansible_api_url, sync_state)
+    if failed_jobs := download_jobs(job_data_objects):
+        logging.error(
+            f"Failed to download stdout for {len(failed_jobs)} jobs: {failed_jobs}"
+        )
+        sys.exit(1)
+    save_sync_state(sync_state, job_data_objects)
+    store = FindingsStore(findings_db)
+    store.add_jobs(job_data_objects)
+    writer = FindingsWriter(store)
+    try:
+        run_trufflehog(writer)
+    finally:
+        writer.close()
+        store.close()
+else:
+    store = FindingsStore(findings_db)
+    writer = FindingsWriter(store)
+    try:
+        job_data_objects, failed_jobs = run_pipeline(sync_state, writer)
+    finally:
+        writer.close()
+        store.close()
+    logging.info(f"Security concerns have been saved to {csv_output}")
+    if failed_jobs:
+        logging.error(
+            f"Failed to download stdout for {len(failed_jobs)} jobs: {failed_jobs}"
+        )
+        sys.exit(1)
+    save_sync_state(sync_state, job_data_objects)
 
 print(f"Security concerns have been saved to {csv_output}")
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+aap_mock.py - Local stand-in for the AAP (AWX) API
+Description:
+    Serves enough of /api/v2/ for aap_leak_check.py, get_aap_objects_to_remediate.py and fix_aap_org.py
+    to run against it offline: /jobs/ (with the finished__gt, id__gt, finished__isnull and status
+    filters and order_by), /jobs/<id>/, /jobs/<id>/stdout/ (format=txt_download or txt for the whole
+    stdout; format=json for {"range": ..., "content": ...} with start_line and end_line, like AWX), and
+    list, detail and PATCH of job_templates, workflow_job_templates, projects, inventories and
+    credentials. Lists are paginated like AWX: page and page_size (at most 200), count/next/previous,
+    and a 404 past the last page. Every job's stdout is one deterministic log
+    generated by parselog_bench.py plus a line naming the job, and every --leak-every'th job also
+    leaks a fake AWS key. --latency-ms delays every response and --error-rate answers that fraction
+    of requests with a 503. With --max-display-mb, format=json answers AWX's "Standard Output too large
+    to display" placeholder for stdouts above that size. GET /_stats returns the requests, bytes and
+    errors served so far.
+    Expects parselog_bench.py (and parselog.py) next to it, as installed in ~/bin.
+Usage:
+    aap_mock.py [--port PORT] [--jobs N] [--running N] [--templates N] [--objects N] [--log-mb MB]
+                [--hosts N] [--latency-ms MS] [--error-rate R] [--leak-every N] [--max-display-mb MB]
+                [--seed N]
+    aap_mock.py -h
+Options:
+    -h, --help            show this help message and exit
+    --port PORT           Port to listen on, on 127.0.0.1 (default 8765)
+    --jobs N              Finished jobs (default 1000)
+    --running N           Jobs still running, after the finished ones (default 0)
+    --templates N         Job templates (default 200)
+    --objects N           Objects of each other type (default 500)
+    --log-mb MB           Size of each job's stdout in MB (default 1)
+    --hosts N             Hosts in the generated log (default 20)
+    --latency-ms MS       Delay before every response (default 0)
+    --error-rate R        Fraction of requests answered with a 503 (default 0)
+    --leak-every N        Every Nth job's stdout has a fake AWS key, 0 for none (default 50)
+    --max-display-mb MB   Largest stdout format=json serves, 0 for no limit (default 0; AWX's is 1)
+    --seed N              Random seed for the log and the errors (default 0)
+"""
+
+import argparse
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import parselog_bench
+
+API = "/api/v2/"
+OBJECT_TYPES = (
+    "job_templates",
+    "workflow_job_templates",
+    "projects",
+    "inventories",
+    "credentials",
+)
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 200
+# Parameters that are not field lookups
+LIST_PARAMETERS = ("page", "page_size", "order_by", "format")
+JOBS_START = datetime(2024, 1, 1)
+ROUTE_PATTERN = re.compile(r"^/api/v2/(\w+)/(?:(\d+)/(?:(stdout)/)?)?$")
+WRITE_CHUNK_BYTES = 1 << 20
+
+
+class MockAap:
+    """The jobs, objects and job log served, and what has been served so far."""
+
+    def __init__(self, options):
+        self.latency = options.latency_ms / 1000
+        self.error_rate = options.error_rate
+        self.leak_every = options.leak_every
+        self.max_display_bytes = int(options.max_display_mb * 1024 * 1024)
+        self.rng = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "errors": 0}
+
+        with tempfile.NamedTemporaryFile(suffix=".txt") as file:
+            parselog_bench.generate_log(
+                file.name, options.log_mb, options.hosts, options.seed
+            )
+            self.log = open(file.name, "rb").read()
+
+        templates = max(1, options.templates)
+        self.jobs = []
+        for job_id in range(1, options.jobs + options.running + 1):
+            started = JOBS_START + timedelta(minutes=job_id)
+            finished = started + timedelta(seconds=50)
+            running = job_id > options.jobs
+            self.jobs.append(
+                {
+                    "id": job_id,
+                    "type": "job",
+                    "name": "job template {}".format(job_id % templates + 1),
+                    "job_template": job_id % templates + 1,
+                    "status": "running" if running else "successful",
+                    "started": started.isoformat() + "Z",
+                    "finished": None if running else finished.isoformat() + "Z",
+                }
+            )
+        self.objects = {"jobs": {job["id"]: job for job in self.jobs}}
+        for object_type in OBJECT_TYPES:
+            count = templates if object_type == "job_templates" else options.objects
+            self.objects[object_type] = {
+                number: {
+                    "id": number,
+                    "name": "{} {}".format(object_type, number),
+                    "description": "",
+                    # Every tenth one is in no organization
+                    "organization": None if number % 10 == 0 else number % 3 + 1,
+                    "last_job_run": None,
+                }
+                for number in range(1, count + 1)
+            }
+
+    def stdout(self, job):
+        body = self.log + "job {} {}\n".format(job["id"], job["status"]).encode()
+        if self.leak_every and job["id"] % self.leak_every == 0:
+            body += "aws_access_key_id = AKIA{:016d}\n".format(job["id"]).encode()
+        return body
+
+
+def lookup(item, key, value):
+    """Whether ``item`` passes the AWX field lookup ``key=value`` (exact, gt, lt, isnull, in)."""
+    field, _, operator = key.partition("__")
+    if field not in item:
+        return True
+    actual = item[field]
+    if operator == "isnull":
+        return (actual is None) == (value.lower() == "true")
+    if actual is None:
+        return False
+    if operator == "in":
+        return str(actual) in value.split(",")
+    expected = type(actual)(value) if isinstance(actual, int) else value
+    if operator == "gt":
+        return actual > expected
+    if operator == "lt":
+        return actual < expected
+    return actual == expected
+
+
+def ordered(items, order_by):
+    field = order_by.lstrip("-")
+    return sorted(
+        items,
+        key=lambda item: (item.get(field) is None, item.get(field) or 0),
+        reverse=order_by.startswith("-"),
+    )
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    aap = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type="application/json", counted=True):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        view = memoryview(body)
+        for start in range(0, len(body), WRITE_CHUNK_BYTES):
+            self.wfile.write(view[start : start + WRITE_CHUNK_BYTES])
+        if counted:
+            with self.aap.lock:
+                self.aap.stats["bytes"] += len(body)
+
+    def handle_request(self, method):
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+        if url.path == "/_stats":
+            with self.aap.lock:
+                stats = dict(self.aap.stats)
+            return self.send(200, stats, counted=False)
+        with self.aap.lock:
+            self.aap.stats["requests"] += 1
+            failed = self.aap.rng.random() < self.aap.error_rate
+            if failed:
+                self.aap.stats["errors"] += 1
+        time.sleep(self.aap.latency)
+        if failed:
+            return self.send(503, {"detail": "Service unavailable."})
+        if "Authorization" not in self.headers:
+            return self.send(
+                401, {"detail": "Authentication credentials were not provided."}
+            )
+        match = ROUTE_PATTERN.match(
+            url.path if url.path.endswith("/") else url.path + "/"
+        )
+        if match is None or match.group(1) not in self.aap.objects:
+            return self.send(404, {"detail": "Not found."})
+        object_type, number, stdout = match.groups()
+        objects = self.aap.objects[object_type]
+        if number is not None:
+            item = objects.get(int(number))
+            if item is None:
+                return self.send(404, {"detail": "Not found."})
+            if stdout:
+                return self.send_stdout(item, query)
+            if method == "PATCH":
+                length = int(self.headers.get("Content-Length", 0))
+                with self.aap.lock:
+                    item.update(json.loads(self.rfile.read(length) or b"{}"))
+            return self.send(200, item)
+        if method != "GET":
+            return self.send(405, {"detail": 'Method "{}" not allowed.'.format(method)})
+        return self.send_list(url.path, list(objects.values()), query)
+
+    def send_list(self, path, items, query):
+        for key, value in query.items():
+            if key not in LIST_PARAMETERS:
+                items = [item for item in items if lookup(item, key, value)]
+        items = ordered(items, query.get("order_by", "id"))
+        page = int(query.get("page", 1))
+        page_size = min(int(query.get("page_size", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        pages = max(1, -(-len(items) // page_size))
+        if page < 1 or page > pages:
+            return self.send(404, {"detail": "Invalid page."})
+
+        def link(number):
+            return "{}?{}".format(path, urlencode({**query, "page": number}))
+
+        self.send(
+            200,
+            {
+                "count": len(items),
+                "next": link(page + 1) if page < pages else None,
+                "previous": link(page - 1) if page > 1 else None,
+                "results": items[(page - 1) * page_size : page * page_size],
+            },
+        )
+
+    def send_stdout(self, job, query):
+        body = self.aap.stdout(job)
+        if query.get("format") != "json":
+            # AWX ignores start_line and end_line for txt and txt_download
+            return self.send(200, body, "text/plain")
+        if self.aap.max_display_bytes and len(body) > self.aap.max_display_bytes:
+            content = (
+                "Standard Output too large to display ({} bytes), only download supported for "
+                "sizes over {} bytes.".format(len(body), self.aap.max_display_bytes)
+            )
+            return self.send(
+                200,
+                {
+                    "range": {"start": 0, "end": 1, "absolute_end": 1},
+                    "content": content,
+                },
+            )
+        lines = body.decode().splitlines(keepends=True)
+        start = int(query.get("start_line", 0))
+        end = min(int(query.get("end_line", len(lines))), len(lines))
+        self.send(
+            200,
+            {
+                "range": {"start": start, "end": end, "absolute_end": len(lines)},
+                "content": "".join(lines[start:end]),
+            },
+        )
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+
+def serve(options):
+    """Start the mock on a background thread; returns the server (``server.aap`` has its state)."""
+    handler = type("MockHandler", (Handler,), {"aap": MockAap(options)})
+    server = ThreadingHTTPServer(("127.0.0.1", options.port), handler)
+    server.daemon_threads = True
+    server.aap = handler.aap
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--jobs", type=int, default=1000, help="Finished jobs")
+    parser.add_argument("--running", type=int, default=0, help="Jobs still running")
+    parser.add_argument("--templates", type=int, default=200, help="Job templates")
+    parser.add_argument(
+        "--objects", type=int, default=500, help="Objects of each other type"
+    )
+    parser.add_argument(
+        "--log-mb",
+        dest="log_mb",
+        type=float,
+        default=1,
+        help="Size of each job's stdout in MB",
+    )
+    parser.add_argument(
+        "--hosts", type=int, default=20, help="Hosts in the generated log"
+    )
+    parser.add_argument(
+        "--latency-ms",
+        dest="latency_ms",
+        type=float,
+        default=0,
+        help="Delay before every response",
+    )
+    parser.add_argument(
+        "--error-rate",
+        dest="error_rate",
+        type=float,
+        default=0,
+        help="Fraction of requests answered with a 503",
+    )
+    parser.add_argument(
+        "--leak-every",
+        dest="leak_every",
+        type=int,
+        default=50,
+        help="Every Nth job's stdout has a fake AWS key",
+    )
+    parser.add_argument(
+        "--max-display-mb",
+        dest="max_display_mb",
+        type=float,
+        default=0,
+        help="Largest stdout format=json serves, 0 for no limit",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+
+def main(options):
+    server = serve(options)
+    print(
+        "serving http://127.0.0.1:{}{} ({} jobs)".format(
+            options.port, API, len(server.aap.jobs)
+        )
+    )
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the AAP API")
+    add_arguments(parser)
+
+    options = parser.parse_args()
+
+    main(options)
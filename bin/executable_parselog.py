@@ -3,30 +3,2003 @@
 parselog.py - Parse Ansible log files
 Description:
     This script parses Ansible log files and extracts the output for a specific host or all hosts.
-    It can also skip skipped tasks if specified. It creates a tmp directory in the current path for the files. It then attempts to open the new files in VS Code.
+    It can also skip skipped tasks if specified, or keep only some statuses (--status failed,changed) and
+    tasks (--task/--exclude-task REGEX); filtered results never open a block, so they cost nothing to write
+    and with -a only hosts with a selected result get a file. It creates a tmp directory in the current path for the files. It then attempts to open the new files in VS Code.
+    The input file is read once; each host's task blocks are streamed to its own output file as they are found.
+    The first run over a file also records its TASK boundaries and per-host byte ranges in ~/.parselog/index
+    (keyed by size, mtime and a sampled hash), so later queries against the same file seek straight to them.
+    Indexing and writing work on the raw bytes of the mmap'd file; plain ASCII logs are copied to the per-host
+    files as slices of the map without being decoded (parselog_bench.py measures the gain).
+    Logs ending in .gz, .xz or .zst (zstd needs the zstandard package before Python 3.14) are decompressed
+    on the fly in a reader thread and parsed in the same single streaming pass, without the index.
+    With --follow the file is tailed like tailstop: newly appended lines are parsed as they arrive, each host's
+    file is flushed as its blocks finish, and parsing stops once PLAY RECAP (or --stop KEYWORD) has been read.
+    With --export, one record per (host, task) block is written instead, with status, changed, the
+    profile_tasks duration and the block's byte offset and length, as JSON Lines or Parquet (needs pyarrow).
+    Compressed logs, or any log with --no-index, are exported from the same streaming pass instead.
+    With --diff, the task sequences of two hosts (or of the same hosts in two logs) are aligned by task
+    name and each task body is hashed, so identical tasks are skipped and only divergent ones are read back
+    and printed as unified diffs. Host names and start/end/delta values are masked before comparing.
+    With --job-id, the job's stdout is streamed from the AAP API (token in $AAP_DEV_RW_TOKEN) in chunks
+    straight into the parser, so the per-host files are done when the download is; the raw log is saved
+    next to them as job_<id>.txt instead of being held in memory.
+    With --dir, every job log in a directory (e.g. the job_<id>.txt files aap_leak_check.py downloads) is
+    split in a bounded pool of -j processes (each log indexed in a throwaway sidecar, leaving ~/.parselog/index
+    alone), printing a progress line per log on stderr, and each host gets one history-<host>.txt with its
+    results from every job, oldest job id first.
+    With --stats, the same pass also collects the PLAY RECAP counters per host and the profile_tasks
+    elapsed time per task, written to stats-<input>.json and printed (and saved) as a summary table of host
+    counters and the slowest tasks.
+    Other tools can import this file as a module and consume iter_events(lines), which yields TaskStart,
+    HostResultStart, ResultLine, HostResultEnd, PlayRecap, RecapLine and TaskTiming events lazily from any iterable of lines.
 Usage:
     parselog.py -n <HOSTNAME> -f <INPUTFILE> [-s]
     parselog.py -a -f <INPUTFILE> [-s]
+    parselog.py -a -f <INPUTFILE> [--status STATUS[,STATUS]] [--task REGEX] [--exclude-task REGEX]
+    parselog.py -n <HOSTNAME> -n <HOSTNAME> -f <INPUTFILE> --diff
+    parselog.py -a|-n <HOSTNAME> -f <INPUTFILE> --diff <OTHERFILE>
+    parselog.py -a|-n <HOSTNAME> --job-id <JOB_ID> [-s]
+    parselog.py --dir <DATADIR> --host <HOSTNAME> [-j JOBS]
+    parselog.py -a -f <INPUTFILE> --follow [--stop KEYWORD]
+    parselog.py -a -f <INPUTFILE> --export <FILE.jsonl|FILE.parquet>
     parselog.py -h
 Options:
     -h, --help            show this help message and exit
-    -n HOSTNAME, --hostname HOSTNAME
+    -n HOSTNAME, --hostname HOSTNAME, --host HOSTNAME
                         Hostname(s) (may be IP address) to match
     -a, --all            Match all hosts
     -f INPUTFILE, --file INPUTFILE
-                        Input file to process
+                        Input file to process (may be .gz, .xz or .zst)
+    --job-id JOB_ID      Stream this AAP job's stdout from the API instead of reading a file
+    --aap-url URL        AAP jobs API URL for --job-id (default: https://mihdqdevc01.marriott.com/api/v2/jobs/)
+    --dir DATADIR        Process every job log in this directory into per-host histories
     -s, --no-skipped     Don't print skipped tasks
+    --status STATUSES    Only print results with these comma-separated statuses (failed also matches fatal)
+    --task REGEX         Only print tasks whose name matches this regular expression
+    --exclude-task REGEX Don't print tasks whose name matches this regular expression
+    --no-index           Don't build or use the byte-offset index in ~/.parselog/index
+    -j JOBS, --jobs JOBS  Worker processes for scanning and writing large files
+    --stats              Also write PLAY RECAP counters and profile_tasks timings to stats-* files
+    --diff [OTHERFILE]   Print the tasks that differ between the two -n hosts, or between INPUTFILE and this log
+    --export FILE        Write one record per host task to this .jsonl or .parquet file instead
+    --follow             Keep reading the file as it grows until the stop keyword appears
+    --stop KEYWORD       Keyword that ends --follow (default: PLAY RECAP)
     -d, --debug          Debug output
     -v, --verbose        Verbose output
 """
 
 import argparse
+import difflib
+import gzip
+import hashlib
+import io
+import json
 import logging
+import lzma
+import mmap
 import os
+import queue
 import re
+import shutil
+import stat
+import sys
 import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from itertools import chain, islice
 
 debug = True
+logger = logging.getLogger(__name__)
+
+# Cap on simultaneously open per-host output files; the rest are reopened in
+# append mode when their host shows up again.
+MAX_OPEN_FILES = 64
+
+ALL_HOSTS_PATTERN = re.compile(r"^\w+: \[([\S]+?)\] =>")
+HOST_LINE_PATTERN = re.compile(r"(\w+): \[([^\]]+)\]")
+OTHER_HOST_PATTERN = re.compile(r"\w+: \[(\S*)")
+LOWERCASE_STATUS_PATTERN = re.compile(r"[a-z]+")
+# Handlers start a task like TASK banners do, and profile_tasks times them too.
+TASK_BANNERS = ("TASK", "RUNNING HANDLER")
+# Byte-level patterns for the mmap'd index path. Each one opens with a
+# literal so the regex engine can skip ahead instead of trying every offset:
+# LINE_START finds TASK and handler lines, host result lines and blank lines
+# by the newline before them (FIRST_LINE covers the start of the file) and
+# BRACE finds lines that end in a closing brace.
+LINE_EVENT_BYTES = (
+    rb"(?:(TASK|RUNNING HANDLER)|(\w+): \[([^\]\n]+)\]|(?=[ \t\r\f\v]*(?:\n|\Z)))"
+)
+FIRST_LINE_BYTES_PATTERN = re.compile(LINE_EVENT_BYTES)
+LINE_START_BYTES_PATTERN = re.compile(rb"\n" + LINE_EVENT_BYTES)
+BRACE_BYTES_PATTERN = re.compile(rb"\}[ \t\r\f\v]*(?:\n|\Z)")
+ALL_HOSTS_BYTES_PATTERN = re.compile(rb"\w+: \[([\S]+?)\] =>")
+OTHER_HOST_BYTES_PATTERN = re.compile(rb"\n\w+: \[(\S*)")
+RAW_CHECK_BYTES = 1 << 24
+# Ansible prints failed results as "fatal: [host]: FAILED!", and loop items as "failed:".
+STATUS_ALIASES = {"failed": ("failed", "fatal")}
+# profile_tasks prints "<date> (<previous task elapsed>)   <total elapsed> ****"
+PROFILE_TASKS_REGEX = (
+    r"[^\n]*\((\d+):(\d+):(\d+(?:\.\d+)?)\)\s+\d+:\d+:\d+(?:\.\d+)?\s+\*"
+)
+PROFILE_TASKS_PATTERN = re.compile(PROFILE_TASKS_REGEX)
+PROFILE_TASKS_BYTES_PATTERN = re.compile(PROFILE_TASKS_REGEX.encode("ASCII"))
+# "<host> : ok=3    changed=1    unreachable=0    failed=0 ..." under PLAY RECAP
+RECAP_LINE_PATTERN = re.compile(r"(\S+)\s+: ((?:\w+=\d+\s*)+)$")
+RECAP_COUNTER_PATTERN = re.compile(r"(\w+)=(\d+)")
+STATS_COUNTERS = (
+    "ok",
+    "changed",
+    "unreachable",
+    "failed",
+    "skipped",
+    "rescued",
+    "ignored",
+)
+STATS_TOP_TASKS = 20
+CHANGED_TRUE = '"changed": true'
+CHANGED_TRUE_BYTES = CHANGED_TRUE.encode("ASCII")
+# Per-run values that would make every command task differ between two logs.
+DIFF_VOLATILE_PATTERN = re.compile(r'"(start|end|delta)": "[^"]*"')
+# --export writes rows in batches of this many (one Parquet row group each).
+EXPORT_BATCH_ROWS = 50000
+
+# Compressed logs are decompressed by a reader thread that stays at most
+# DECOMPRESS_QUEUE_CHUNKS chunks of DECOMPRESS_CHUNK_BYTES ahead of the parser.
+COMPRESSED_SUFFIXES = (".gz", ".xz", ".zst")
+DECOMPRESS_CHUNK_BYTES = 1 << 20
+DECOMPRESS_QUEUE_CHUNKS = 16
+
+# --follow polls the growing log this often and stops once a line containing
+# the stop keyword has been read and the file holds nothing more.
+FOLLOW_POLL_SECONDS = 1.0
+FOLLOW_READ_BYTES = 1 << 20
+FOLLOW_STOP_KEYWORD = "PLAY RECAP"
+
+# --job-id streams a job's stdout from the AAP jobs API, authenticated with
+# the token aap_leak_check.py uses.
+AAP_JOBS_URL = "https://mihdqdevc01.marriott.com/api/v2/jobs/"
+AAP_TOKEN_ENV = "AAP_DEV_RW_TOKEN"
+AAP_TIMEOUT = (10, 300)
+JOB_STDOUT_CHUNK_BYTES = 1 << 20
+
+# --dir parses every job log in a directory, oldest AAP job id first, keeping
+# at most FLEET_PENDING_PER_JOB logs per worker queued in the pool.
+FLEET_LOG_SUFFIXES = (".txt", ".log")
+FLEET_PENDING_PER_JOB = 2
+JOB_NUMBER_PATTERN = re.compile(r"job_(\d+)")
+
+# Byte-offset index sidecars live next to the log file of this script.
+INDEX_DIR = os.path.join(os.path.expanduser("~"), ".parselog", "index")
+INDEX_MAGIC = b"PLIX3\n"
+INDEX_SAMPLE_BYTES = 1 << 16
+# Least recently used sidecars beyond this count are removed.
+INDEX_KEEP = 200
+# --jobs splits the file into this many chunks per worker to even out the load.
+CHUNKS_PER_JOB = 4
+# Each host block is stored as (task number + 1, status number, start, end).
+INDEX_RECORD_FIELDS = 4
+
+
+class HostWriterPool:
+    """Per-host binary output files behind a bounded LRU of open handles."""
+
+    def __init__(self, path_for, max_open=MAX_OPEN_FILES):
+        self.path_for = path_for
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.created = set()
+
+    def write(self, host, text):
+        handle = self.handles.get(host)
+        if handle is None:
+            handle = self._open(host)
+        else:
+            self.handles.move_to_end(host)
+        handle.write(text)
+
+    def touch(self, host):
+        if host not in self.created:
+            self._open(host)
+
+    def discard(self, host):
+        handle = self.handles.pop(host, None)
+        if handle is not None:
+            handle.close()
+        if host in self.created:
+            self.created.discard(host)
+            os.remove(self.path_for(host))
+
+    def flush(self, host=None):
+        if host is None:
+            for handle in self.handles.values():
+                handle.flush()
+        elif host in self.handles:
+            self.handles[host].flush()
+
+    def close(self):
+        while self.handles:
+            _, handle = self.handles.popitem(last=False)
+            handle.close()
+
+    def _open(self, host):
+        if len(self.handles) >= self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        mode = "ab" if host in self.created else "wb"
+        handle = open(self.path_for(host), mode)
+        self.created.add(host)
+        self.handles[host] = handle
+        return handle
+
+
+def selects_status(status, skip_skipped):
+    """Whether a result line with this status opens a block under ``-s``."""
+    if not skip_skipped:
+        return True
+    return status != "skipping" and bool(LOWERCASE_STATUS_PATTERN.fullmatch(status))
+
+
+@dataclass(slots=True, frozen=True)
+class BlockFilter:
+    """
+    Which results open a block: ``-s``, ``--status``, ``--task`` and ``--exclude-task``.
+
+    ``statuses`` is a set of result statuses (None means any); ``task`` and
+    ``exclude_task`` are compiled patterns searched in the task name.
+    """
+
+    skip_skipped: bool = False
+    statuses: frozenset = None
+    task: re.Pattern = None
+    exclude_task: re.Pattern = None
+
+    @classmethod
+    def from_options(cls, skip_skipped, statuses=None, task=None, exclude_task=None):
+        if statuses is not None:
+            names = set()
+            for status in statuses.split(","):
+                status = status.strip()
+                names.update(STATUS_ALIASES.get(status, (status,)))
+            statuses = frozenset(names)
+        return cls(
+            skip_skipped,
+            statuses,
+            None if task is None else re.compile(task),
+            None if exclude_task is None else re.compile(exclude_task),
+        )
+
+    @property
+    def narrows(self):
+        """Whether hosts can end up with no blocks at all, so -a should leave them out."""
+        return not (
+            self.statuses is None and self.task is None and self.exclude_task is None
+        )
+
+    def selects_task(self, name):
+        if self.task is not None and self.task.search(name) is None:
+            return False
+        return self.exclude_task is None or self.exclude_task.search(name) is None
+
+    def selects_status(self, status):
+        if self.statuses is not None and status not in self.statuses:
+            return False
+        return selects_status(status, self.skip_skipped)
+
+
+NO_FILTER = BlockFilter()
+
+
+def task_name(line):
+    return line.partition("[")[2].rpartition("]")[0]
+
+
+def is_other_host_line(line, inventory_hostname, exact=False):
+    """
+    Result lines for other hosts are dropped from a host's output.
+
+    The host is matched as a prefix, as the output has always been split;
+    ``exact`` compares the whole bracketed name (or its ``-> delegate``
+    form), so ``web1`` does not claim ``web10``'s lines.
+    """
+    match = OTHER_HOST_PATTERN.match(line)
+    if match is None or "]" not in match.group(1)[1:]:
+        return False
+    if not line.startswith(inventory_hostname, match.start(1)):
+        return True
+    if not exact:
+        return False
+    return line[match.start(1) + len(inventory_hostname)] not in "] "
+
+
+@dataclass(slots=True, frozen=True)
+class TaskStart:
+    """A ``TASK [...]`` or ``RUNNING HANDLER [...]`` banner line."""
+
+    lineno: int
+    line: str
+
+    @property
+    def name(self):
+        return task_name(self.line)
+
+
+@dataclass(slots=True, frozen=True)
+class HostResultStart:
+    """
+    A ``<status>: [<host>]`` line, which opens a block for ``host``.
+
+    ``detailed`` marks the ``<status>: [<host>] =>`` form. ``skipped`` results
+    were dropped by the block filter and did not open a block.
+    """
+
+    lineno: int
+    line: str
+    host: str
+    status: str
+    task: str
+    detailed: bool
+    skipped: bool = False
+
+
+@dataclass(slots=True, frozen=True)
+class ResultLine:
+    """A line inside the currently open blocks of ``hosts``."""
+
+    lineno: int
+    line: str
+    hosts: tuple
+
+
+@dataclass(slots=True, frozen=True)
+class HostResultEnd:
+    """The block for ``host`` closed after line ``lineno``."""
+
+    lineno: int
+    host: str
+
+
+@dataclass(slots=True, frozen=True)
+class PlayRecap:
+    """The ``PLAY RECAP`` banner line."""
+
+    lineno: int
+    line: str
+
+
+@dataclass(slots=True, frozen=True)
+class RecapLine:
+    """A ``<host> : ok=N changed=N ...`` line under PLAY RECAP."""
+
+    lineno: int
+    line: str
+    host: str
+    counters: dict
+
+
+@dataclass(slots=True, frozen=True)
+class TaskTiming:
+    """
+    A ``profile_tasks`` timestamp line.
+
+    It follows a TASK banner, or the PLAY RECAP lines, and ``seconds`` is how
+    long the task before that banner took.
+    """
+
+    lineno: int
+    line: str
+    seconds: float
+
+
+def profile_seconds(match):
+    hours, minutes, seconds = match.group(1, 2, 3)
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def recap_counters(text):
+    return {name: int(value) for name, value in RECAP_COUNTER_PATTERN.findall(text)}
+
+
+def iter_events(lines, hostnames=None, block_filter=NO_FILTER):
+    """
+    Yield parse events for an iterable of log lines, one line at a time.
+
+    A block opens on a ``<status>: [<host>]`` line and runs until the next
+    TASK line, a lone closing brace, or the first blank line after a closing
+    brace. ``hostnames`` limits which hosts open blocks (None means all) and
+    ``block_filter`` which statuses and tasks may open them. Result
+    lines are reported once per line with every host whose block holds them,
+    so nothing is buffered per host.
+    """
+    wanted = None if hostnames is None else set(hostnames)
+    active = {}
+    active_hosts = ()
+    latest_task = ""
+    task_selected = block_filter.selects_task("")
+    check_nextline_blank = False
+    timing_next = False
+    in_recap = False
+    lineno = 0
+
+    for lineno, line in enumerate(lines, 1):
+        if timing_next:
+            timing_next = False
+            timing = PROFILE_TASKS_PATTERN.match(line)
+            if timing:
+                yield TaskTiming(lineno, line, profile_seconds(timing))
+        elif in_recap:
+            recap = RECAP_LINE_PATTERN.match(line)
+            if recap:
+                yield RecapLine(
+                    lineno, line, recap.group(1), recap_counters(recap.group(2))
+                )
+            else:
+                timing = PROFILE_TASKS_PATTERN.match(line)
+                if timing:
+                    in_recap = False
+                    yield TaskTiming(lineno, line, profile_seconds(timing))
+        if line.startswith(TASK_BANNERS):
+            for host in active:
+                yield HostResultEnd(lineno - 1, host)
+            active.clear()
+            active_hosts = ()
+            latest_task = line
+            task_selected = block_filter.selects_task(task_name(line))
+            timing_next = True
+            in_recap = False
+            yield TaskStart(lineno, line)
+        elif line.startswith("PLAY RECAP"):
+            in_recap = True
+            yield PlayRecap(lineno, line)
+        match = HOST_LINE_PATTERN.match(line)
+        if match:
+            status, host = match.groups()
+            if wanted is None or host in wanted:
+                opens = task_selected and block_filter.selects_status(status)
+                if opens:
+                    if host in active:
+                        yield HostResultEnd(lineno - 1, host)
+                    active[host] = lineno
+                    active_hosts = tuple(active)
+                yield HostResultStart(
+                    lineno,
+                    line,
+                    host,
+                    status,
+                    latest_task,
+                    ALL_HOSTS_PATTERN.match(line) is not None,
+                    not opens,
+                )
+        if active_hosts:
+            yield ResultLine(lineno, line, active_hosts)
+        stripped = line.rstrip()
+        closing = False
+        if stripped.endswith("}"):
+            closing = stripped == "}"
+            check_nextline_blank = True
+        elif not stripped and check_nextline_blank:
+            closing = True
+            check_nextline_blank = False
+        if closing and active:
+            for host in active:
+                yield HostResultEnd(lineno, host)
+            active.clear()
+            active_hosts = ()
+    for host in active:
+        yield HostResultEnd(lineno, host)
+
+
+class RunStats:
+    """
+    PLAY RECAP counters and profile_tasks timings, gathered while a log is split.
+
+    ``add`` takes events from ``iter_events``; ``LogIndex.collect_stats``
+    fills it from the index instead.
+    """
+
+    def __init__(self):
+        self.recap = {}
+        self.task_names = [""]
+        self.durations = {}
+        self.host_tasks = {}
+        self.recap_seen = False
+
+    def add(self, event):
+        kind = type(event)
+        if kind is TaskStart:
+            self.task_names.append(event.name)
+            self.recap_seen = False
+        elif kind is HostResultStart:
+            if not event.skipped:
+                self.host_tasks.setdefault(event.host, set()).add(
+                    len(self.task_names) - 1
+                )
+        elif kind is PlayRecap:
+            self.recap_seen = True
+        elif kind is TaskTiming:
+            # The timing of a task is printed after the next banner.
+            task_number = len(self.task_names) - (1 if self.recap_seen else 2)
+            if task_number > 0:
+                self.durations[task_number] = event.seconds
+        elif kind is RecapLine:
+            self.add_recap(event.host, event.counters)
+
+    def add_recap(self, host, counters):
+        totals = self.recap.setdefault(host, dict.fromkeys(STATS_COUNTERS, 0))
+        for name, value in counters.items():
+            totals[name] = totals.get(name, 0) + value
+
+    def as_dict(self, source=""):
+        """
+        The stats as plain data for JSON.
+
+        Tasks are grouped by name, slowest total first. A host's
+        ``task_seconds`` adds up the tasks it had a result in, so it is the
+        time the play spent on that host's tasks, not the host's own runtime.
+        """
+        tasks = {}
+        for task_number, seconds in self.durations.items():
+            entry = tasks.setdefault(
+                self.task_names[task_number],
+                {
+                    "task": self.task_names[task_number],
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                },
+            )
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+        for entry in tasks.values():
+            entry["total"] = round(entry["total"], 3)
+            entry["mean"] = round(entry["total"] / entry["count"], 3)
+        hosts = {}
+        for host in sorted(set(self.recap) | set(self.host_tasks)):
+            hosts[host] = dict(self.recap.get(host, dict.fromkeys(STATS_COUNTERS, 0)))
+            hosts[host]["task_seconds"] = round(
+                sum(
+                    self.durations.get(task, 0.0)
+                    for task in self.host_tasks.get(host, ())
+                ),
+                3,
+            )
+        return {
+            "file": source,
+            "tasks_run": len(self.task_names) - 1,
+            "total_seconds": round(sum(self.durations.values()), 3),
+            "hosts": hosts,
+            "tasks": sorted(
+                tasks.values(), key=lambda entry: entry["total"], reverse=True
+            ),
+        }
+
+    def table(self, source=""):
+        """A plain-text summary: every host's counters and the slowest tasks."""
+        summary = self.as_dict(source)
+        columns = STATS_COUNTERS + ("task_seconds",)
+        width = max([len("HOST")] + [len(host) for host in summary["hosts"]])
+        lines = [
+            "{}  {:.1f}s over {} tasks".format(
+                source, summary["total_seconds"], summary["tasks_run"]
+            ),
+            "",
+            "{:<{}}".format("HOST", width)
+            + "".join(" {:>12}".format(c) for c in columns),
+        ]
+        hosts = sorted(
+            summary["hosts"].items(),
+            key=lambda item: (-item[1]["failed"] - item[1]["unreachable"], item[0]),
+        )
+        for host, counters in hosts:
+            lines.append(
+                "{:<{}}".format(host, width)
+                + "".join(" {:>12}".format(counters.get(c, 0)) for c in columns)
+            )
+        lines += [
+            "",
+            "{:>9} {:>9} {:>9} {:>6}  SLOWEST TASKS".format(
+                "TOTAL", "MEAN", "MAX", "RUNS"
+            ),
+        ]
+        for entry in summary["tasks"][:STATS_TOP_TASKS]:
+            lines.append(
+                "{:>9.3f} {:>9.3f} {:>9.3f} {:>6}  {}".format(
+                    entry["total"],
+                    entry["mean"],
+                    entry["max"],
+                    entry["count"],
+                    entry["task"],
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+
+def demux(
+    lines, writers, hostnames=None, block_filter=NO_FILTER, flush=False, stats=None
+):
+    """
+    Route each host's task blocks from ``lines`` to ``writers`` in one pass.
+
+    Every block is written after a blank line and its TASK line. With
+    ``hostnames=None`` every host that has a ``<status>: [<host>] =>`` line is
+    written, or only those with a selected block if ``block_filter`` narrows
+    by status or task. ``flush`` pushes each block to disk as soon as it closes, for
+    logs that are still being written. ``stats`` is a RunStats fed from the same
+    pass. Returns the set of hosts that got an output file.
+    """
+    wanted = None if hostnames is None else set(hostnames)
+    seen = set()
+    confirmed = set()
+
+    try:
+        for event in iter_events(lines, hostnames, block_filter):
+            kind = type(event)
+            if kind is ResultLine:
+                data = event.line.encode("ASCII")
+                for host in event.hosts:
+                    if not is_other_host_line(event.line, host):
+                        writers.write(host, data)
+            elif kind is HostResultStart:
+                if wanted is None:
+                    seen.add(event.host)
+                    if event.detailed:
+                        confirmed.add(event.host)
+                if not event.skipped:
+                    writers.write(event.host, ("\n" + event.task).encode("ASCII"))
+                if stats is not None:
+                    stats.add(event)
+            elif kind is HostResultEnd:
+                if flush:
+                    writers.flush(event.host)
+            elif stats is not None:
+                stats.add(event)
+    finally:
+        writers.close()
+
+    if wanted is None:
+        # Hosts only ever seen without "=>" were never part of --all.
+        for host in seen - confirmed:
+            writers.discard(host)
+        if stats is not None:
+            # As collect_stats: delegations like "web1 -> localhost" are no hosts.
+            stats.host_tasks = {
+                host: tasks
+                for host, tasks in stats.host_tasks.items()
+                if host in confirmed
+            }
+        wanted = confirmed
+        if block_filter.narrows:
+            wanted = wanted & writers.created
+    for host in wanted:
+        writers.touch(host)
+    writers.close()
+    return wanted
+
+
+def decode_log_bytes(data):
+    """Decode raw log bytes the way the text-mode reader would."""
+    return (
+        data.decode("ASCII", errors="ignore").replace("\r\n", "\n").replace("\r", "\n")
+    )
+
+
+def index_key(inputfile):
+    """
+    Key a log by size, mtime and a hash of its first and last 64 KiB.
+
+    Sampling keeps the lookup constant-time on multi-GB logs while still
+    catching a file that was rewritten in place with the same size.
+    """
+    st = os.stat(inputfile)
+    digest = hashlib.blake2b(f"{st.st_size}:{st.st_mtime_ns}".encode(), digest_size=16)
+    with open(inputfile, "rb") as file:
+        digest.update(file.read(INDEX_SAMPLE_BYTES))
+        if st.st_size > INDEX_SAMPLE_BYTES:
+            file.seek(max(INDEX_SAMPLE_BYTES, st.st_size - INDEX_SAMPLE_BYTES))
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def is_raw(mm, start, end):
+    """Whether ``mm[start:end]`` is plain ASCII without carriage returns."""
+    if mm.find(b"\r", start, end) >= 0:
+        return False
+    for position in range(start, end, RAW_CHECK_BYTES):
+        if not mm[position : min(position + RAW_CHECK_BYTES, end)].isascii():
+            return False
+    return True
+
+
+@contextmanager
+def mapped(inputfile):
+    """Map ``inputfile`` read-only (an empty file maps to ``b""``)."""
+    with open(inputfile, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def blank_check_before(mm, offset):
+    """
+    Replay ``check_nextline_blank`` for the line starting at ``offset``.
+
+    The flag is set by a line ending in a closing brace and cleared by the
+    next blank line, so it only depends on whichever of the two came last.
+    """
+    window = 1 << 12
+    while True:
+        start = max(0, offset - window)
+        lines = mm[start:offset].split(b"\n")
+        # Drop what follows the final newline and, unless the window reaches
+        # the start of the file, the partial line at its front.
+        lines.pop()
+        for line in reversed(lines[1:] if start else lines):
+            stripped = line.rstrip()
+            if stripped.endswith(b"}"):
+                return True
+            if not stripped:
+                return False
+        if not start:
+            return False
+        window *= 4
+
+
+def task_chunks(inputfile, parts):
+    """Split ``inputfile`` into up to ``parts`` byte ranges that start on TASK lines."""
+    size = os.path.getsize(inputfile)
+    bounds = [0]
+    with open(inputfile, "rb") as file:
+        for part in range(1, parts):
+            position = max(size * part // parts, bounds[-1] + 1)
+            if position >= size:
+                break
+            file.seek(position - 1)
+            base = position - 1
+            buffer = b""
+            while True:
+                block = file.read(1 << 20)
+                if not block:
+                    position = size
+                    break
+                # Keep a few bytes so a match straddling two reads is found.
+                carry = buffer[-4:]
+                base += len(buffer) - len(carry)
+                buffer = carry + block
+                found = buffer.find(b"\nTASK")
+                if found >= 0:
+                    position = base + found + 1
+                    break
+            if position >= size:
+                break
+            bounds.append(position)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def scan_index_range(inputfile, start, end):
+    """
+    Index the lines of ``inputfile`` between byte offsets ``start`` and ``end``.
+
+    ``start`` must be the start of the file or of a TASK line, which closes
+    every open block. Returns ``(statuses, confirmed, records, task_offsets,
+    task_lengths, raw)`` with task numbers counted from the start of the
+    range; ``raw`` is False if the range needs decoding before output.
+    """
+    statuses = {}
+    confirmed = set()
+    records = {}
+    task_offsets = array("Q")
+    task_lengths = array("Q")
+    pending = []
+
+    def close_pending(end):
+        for host_records, position in pending:
+            host_records[position] = end
+        pending.clear()
+
+    if start >= end:
+        return [], confirmed, records, task_offsets, task_lengths, True
+    with mapped(inputfile) as mm:
+        check_nextline_blank = blank_check_before(mm, start) if start else False
+        raw = is_raw(mm, start, end)
+        line_starts = (
+            (match.start() + 1, match)
+            for match in LINE_START_BYTES_PATTERN.finditer(mm, max(start - 1, 0), end)
+        )
+        if not start:
+            first = FIRST_LINE_BYTES_PATTERN.match(mm, 0, end)
+            if first:
+                line_starts = chain([(0, first)], line_starts)
+        braces = BRACE_BYTES_PATTERN.finditer(mm, start, end)
+        brace = next(braces, None)
+
+        # Braces end lines, so every brace before the next line start belongs
+        # to an earlier line and is replayed first.
+        for line_start, match in chain(line_starts, [(end, None)]):
+            while brace is not None and brace.start() < line_start:
+                position = brace.start()
+                if position == 0 or mm[position - 1] == 10:
+                    close_pending(brace.end())
+                check_nextline_blank = True
+                brace = next(braces, None)
+            if line_start >= end:
+                break
+            task, status, host = match.groups()
+            if task:
+                close_pending(line_start)
+                line_end = mm.find(b"\n", line_start, end)
+                task_offsets.append(line_start)
+                task_lengths.append(
+                    (end if line_end < 0 else line_end + 1) - line_start
+                )
+            elif host:
+                confirmed_match = ALL_HOSTS_BYTES_PATTERN.match(mm, line_start)
+                if confirmed_match:
+                    confirmed.add(confirmed_match.group(1))
+                status_number = statuses.get(status)
+                if status_number is None:
+                    status_number = statuses[status] = len(statuses)
+                host_records = records.get(host)
+                if host_records is None:
+                    host_records = records[host] = array("Q")
+                host_records.extend((len(task_offsets), status_number, line_start, 0))
+                pending.append((host_records, len(host_records) - 1))
+            elif check_nextline_blank:
+                line_end = mm.find(b"\n", line_start, end)
+                close_pending(end if line_end < 0 else line_end + 1)
+                check_nextline_blank = False
+        close_pending(end)
+        # The regex scanners hold the map's buffer until they are released.
+        del line_starts, braces, brace, match
+    return list(statuses), confirmed, records, task_offsets, task_lengths, raw
+
+
+class LogIndex:
+    """
+    TASK boundaries and host block byte ranges of one log file.
+
+    On disk the sidecar is ``INDEX_MAGIC``, an 8-byte header length, a JSON
+    header and a blob of native ``array("Q")`` tables. The header maps each
+    host to the position of its records in the blob, so a query only reads
+    the records of the hosts it asks for.
+    """
+
+    def __init__(self, path, header, blob_start):
+        self.path = path
+        self.header = header
+        self.blob_start = blob_start
+        self.statuses = header["statuses"]
+        self.task_selection = {}
+        self.raw = header["raw"]
+        self.confirmed = set(header["confirmed"])
+        self.hosts = header["hosts"]
+        self.task_offsets = self._read_table(*header["task_offsets"])
+        self.task_lengths = self._read_table(*header["task_lengths"])
+
+    @classmethod
+    def sidecar_path(cls, inputfile):
+        return os.path.join(INDEX_DIR, "{}.idx".format(index_key(inputfile)))
+
+    @classmethod
+    def read(cls, path):
+        """Open the sidecar at ``path``; None if it is missing or unreadable."""
+        try:
+            with open(path, "rb") as file:
+                if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                    return None
+                header_length = int.from_bytes(file.read(8), "little")
+                header = json.loads(file.read(header_length))
+        except (OSError, ValueError):
+            return None
+        return cls(path, header, len(INDEX_MAGIC) + 8 + header_length)
+
+    @classmethod
+    def load(cls, inputfile):
+        """Return the index for ``inputfile`` or None if there is no current one."""
+        index = cls.read(cls.sidecar_path(inputfile))
+        if index is not None:
+            try:
+                os.utime(index.path)
+            except FileNotFoundError:  # pruned by another process meanwhile
+                return None
+        return index
+
+    @classmethod
+    def build(cls, inputfile, jobs=1, path=None):
+        """
+        Scan ``inputfile`` in binary mode and write its sidecar.
+
+        With ``jobs > 1`` the file is cut into chunks that start on TASK lines
+        and each chunk is scanned in its own process. ``path`` writes the
+        sidecar somewhere other than ``INDEX_DIR``.
+        """
+        chunks = task_chunks(inputfile, jobs * CHUNKS_PER_JOB if jobs > 1 else 1)
+        if len(chunks) == 1:
+            parts = [scan_index_range(inputfile, *chunks[0])]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                parts = list(
+                    pool.map(
+                        scan_index_range,
+                        [inputfile] * len(chunks),
+                        *zip(*chunks),
+                    )
+                )
+        logger.debug("scanned {} in {} chunk(s)".format(inputfile, len(chunks)))
+        statuses, confirmed, records, task_offsets, task_lengths, raw = parts[0]
+        statuses = {status: number for number, status in enumerate(statuses)}
+        for (
+            part_statuses,
+            part_confirmed,
+            part_records,
+            part_offsets,
+            part_lengths,
+            part_raw,
+        ) in parts[1:]:
+            # Every chunk after the first opens on a TASK line, so all of its
+            # records carry a task number and only need shifting.
+            base = len(task_offsets)
+            renumber = [
+                statuses.setdefault(status, len(statuses)) for status in part_statuses
+            ]
+            for host, table in part_records.items():
+                merged = records.get(host)
+                if merged is None:
+                    merged = records[host] = array("Q")
+                for i in range(0, len(table), INDEX_RECORD_FIELDS):
+                    merged.extend(
+                        (
+                            table[i] + base,
+                            renumber[table[i + 1]],
+                            table[i + 2],
+                            table[i + 3],
+                        )
+                    )
+            confirmed |= part_confirmed
+            task_offsets.extend(part_offsets)
+            task_lengths.extend(part_lengths)
+            raw = raw and part_raw
+        offset = chunks[-1][1]
+
+        blob = io.BytesIO()
+
+        def add_table(table):
+            position = blob.tell()
+            blob.write(table.tobytes())
+            return [position, len(table)]
+
+        header = {
+            "size": offset,
+            "raw": raw,
+            "statuses": [
+                status.decode("ASCII") for status in sorted(statuses, key=statuses.get)
+            ],
+            "confirmed": sorted(decode_log_bytes(host) for host in confirmed),
+            "task_offsets": add_table(task_offsets),
+            "task_lengths": add_table(task_lengths),
+            "hosts": {
+                decode_log_bytes(host): add_table(table)
+                for host, table in records.items()
+            },
+        }
+        header_bytes = json.dumps(header, separators=(",", ":")).encode()
+
+        if path is None:
+            path = cls.sidecar_path(inputfile)
+            os.makedirs(INDEX_DIR, exist_ok=True)
+        fd, temppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(INDEX_MAGIC)
+            file.write(len(header_bytes).to_bytes(8, "little"))
+            file.write(header_bytes)
+            file.write(blob.getbuffer())
+        os.replace(temppath, path)
+        logger.debug("wrote index {} for {}".format(path, inputfile))
+        if os.path.dirname(path) == INDEX_DIR:
+            prune_index_dir()
+        return cls(path, header, len(INDEX_MAGIC) + 8 + len(header_bytes))
+
+    def _read_table(self, position, count):
+        table = array("Q")
+        if count:
+            with open(self.path, "rb") as file:
+                file.seek(self.blob_start + position)
+                table.frombytes(file.read(count * table.itemsize))
+        return table
+
+    def selected_tasks(self, mm, block_filter):
+        """Task numbers whose names pass ``block_filter``, or None if it ignores names."""
+        if block_filter.task is None and block_filter.exclude_task is None:
+            return None
+        selected = self.task_selection.get(block_filter)
+        if selected is None:
+            selected = self.task_selection[block_filter] = {
+                task_number
+                for task_number in range(len(self.task_offsets) + 1)
+                if block_filter.selects_task(
+                    task_name(self.task_line(mm, task_number)) if task_number else ""
+                )
+            }
+        return selected
+
+    def blocks(self, host, block_filter=NO_FILTER, tasks=None):
+        """
+        Yield ``(task number, status, start, end)`` for each block of ``host``.
+
+        A block that is still open when the same host opens another one ends
+        there, exactly as the streaming parser hands over to the new block.
+        ``tasks`` is the ``selected_tasks`` set for ``block_filter``.
+        """
+        if host not in self.hosts:
+            return
+        table = self._read_table(*self.hosts[host])
+        selected = [
+            table[i : i + INDEX_RECORD_FIELDS]
+            for i in range(0, len(table), INDEX_RECORD_FIELDS)
+            if block_filter.selects_status(self.statuses[table[i + 1]])
+            and (tasks is None or table[i] in tasks)
+        ]
+        for i, (task_number, status_number, start, end) in enumerate(selected):
+            if i + 1 < len(selected):
+                end = min(end, selected[i + 1][2])
+            yield task_number, self.statuses[status_number], start, end
+
+    def write_host(self, mm, host, writers, block_filter=NO_FILTER, touch=True):
+        """
+        Write ``host``'s blocks from the mapped log ``mm``.
+
+        Raw logs go out as slices of the map with only other hosts' result
+        lines cut out; anything else is decoded the way the text reader would.
+        ``touch=False`` leaves a host without selected blocks without a file.
+        """
+        task_lines = {0: b""}
+        host_bytes = host.encode("ASCII", errors="ignore")
+        with memoryview(mm) as view:
+            tasks = self.selected_tasks(mm, block_filter)
+            for task_number, _, start, end in self.blocks(host, block_filter, tasks):
+                if task_number not in task_lines:
+                    offset = self.task_offsets[task_number - 1]
+                    line = mm[offset : offset + self.task_lengths[task_number - 1]]
+                    if not self.raw:
+                        line = decode_log_bytes(line).encode("ASCII")
+                    task_lines[task_number] = line
+                writers.write(host, b"\n" + task_lines[task_number])
+                if not self.raw:
+                    for line in io.StringIO(decode_log_bytes(mm[start:end])):
+                        if not is_other_host_line(line, host):
+                            writers.write(host, line.encode("ASCII"))
+                    continue
+                for span_start, span_end in own_spans(mm, host_bytes, start, end):
+                    writers.write(host, view[span_start:span_end])
+        if touch:
+            writers.touch(host)
+
+    def task_line(self, mm, task_number):
+        offset = self.task_offsets[task_number - 1]
+        return decode_log_bytes(
+            mm[offset : offset + self.task_lengths[task_number - 1]]
+        )
+
+    def task_durations(self, mm):
+        """
+        Seconds each task took according to ``profile_tasks``, by task number.
+
+        The callback prints the previous task's elapsed time on the line after
+        each TASK banner, and the last task's after the ``PLAY RECAP`` lines.
+        """
+        timings = []
+        for offset, length in zip(self.task_offsets, self.task_lengths):
+            timings.append(PROFILE_TASKS_BYTES_PATTERN.match(mm, offset + length))
+        recap = self.recap_offset(mm)
+        if recap >= 0:
+            timings.append(PROFILE_TASKS_BYTES_PATTERN.search(mm, recap))
+        durations = [None]
+        for match in timings[1:]:
+            durations.append(None if match is None else profile_seconds(match))
+        durations.extend([None] * (len(self.task_offsets) + 1 - len(durations)))
+        return durations
+
+    def recap_offset(self, mm):
+        """Offset of the PLAY RECAP line after the last task, or -1."""
+        recap = mm.find(
+            b"\nPLAY RECAP", self.task_offsets[-1] if self.task_offsets else 0
+        )
+        return recap if recap < 0 else recap + 1
+
+    def collect_stats(self, mm, stats, hosts, block_filter=NO_FILTER):
+        """Fill the RunStats ``stats`` from the index and a few reads of ``mm``."""
+        stats.task_names = [""] + [
+            task_name(self.task_line(mm, task_number))
+            for task_number in range(1, len(self.task_offsets) + 1)
+        ]
+        for task_number, seconds in enumerate(self.task_durations(mm)):
+            if seconds is not None:
+                stats.durations[task_number] = seconds
+        tasks = self.selected_tasks(mm, block_filter)
+        for host in hosts:
+            selected = {block[0] for block in self.blocks(host, block_filter, tasks)}
+            if selected:
+                stats.host_tasks[host] = selected
+        recap = self.recap_offset(mm)
+        if recap < 0:
+            return
+        position = mm.find(b"\n", recap)
+        while position >= 0:
+            line_end = mm.find(b"\n", position + 1)
+            line = decode_log_bytes(
+                mm[position + 1 : None if line_end < 0 else line_end]
+            )
+            match = RECAP_LINE_PATTERN.match(line)
+            if match is None:
+                break
+            stats.add_recap(match.group(1), recap_counters(match.group(2)))
+            position = line_end
+
+    def records(self, mm, hosts, block_filter=NO_FILTER, source=""):
+        """Yield one export row per host block, host by host."""
+        durations = self.task_durations(mm)
+        task_names = {0: ""}
+        tasks = self.selected_tasks(mm, block_filter)
+        for host in hosts:
+            host_bytes = host.encode("ASCII", errors="ignore")
+            for task_number, status, start, end in self.blocks(
+                host, block_filter, tasks
+            ):
+                if task_number not in task_names:
+                    task_names[task_number] = TaskStart(
+                        task_number, self.task_line(mm, task_number)
+                    ).name
+                # The record is the host's own result, up to the first line
+                # of another host's; a multi-line result of that host goes on
+                # with lines that only the examine output keeps.
+                _, own_end = next(own_spans(mm, host_bytes, start, end), (start, end))
+                yield {
+                    "file": source,
+                    "host": host,
+                    "task_number": task_number,
+                    "task": task_names[task_number],
+                    "status": status,
+                    "changed": status == "changed"
+                    or mm.find(CHANGED_TRUE_BYTES, start, own_end) >= 0,
+                    "duration": durations[task_number],
+                    "offset": start,
+                    "length": own_end - start,
+                }
+
+
+def own_spans(mm, host_bytes, start, end):
+    """
+    Yield the byte ranges of the block ``mm[start:end]`` that are the host's own.
+
+    The block opens on this host's own result line, so only the lines after it
+    can belong to other hosts; those are cut out.
+    """
+    position = start
+    for match in OTHER_HOST_BYTES_PATTERN.finditer(mm, start, end):
+        run_start = match.start(1)
+        if b"]" not in match.group(1)[1:] or (
+            mm[run_start : run_start + len(host_bytes)] == host_bytes
+        ):
+            continue
+        if position < match.start() + 1:
+            yield position, match.start() + 1
+        line_end = mm.find(b"\n", match.end(), end)
+        position = end if line_end < 0 else line_end + 1
+    if position < end:
+        yield position, end
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_export(rows, exportfile, batch_rows=EXPORT_BATCH_ROWS):
+    """
+    Write export rows as JSON Lines, or as Parquet if ``exportfile`` ends in .parquet.
+
+    Rows are written in batches of ``batch_rows``; Parquet needs pyarrow and
+    gets one row group per batch. Returns the number of rows written.
+    """
+    count = 0
+    if exportfile.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet export needs the pyarrow package") from None
+        schema = pa.schema(
+            [
+                ("file", pa.string()),
+                ("host", pa.string()),
+                ("task_number", pa.int64()),
+                ("task", pa.string()),
+                ("status", pa.string()),
+                ("changed", pa.bool_()),
+                ("duration", pa.float64()),
+                ("offset", pa.int64()),
+                ("length", pa.int64()),
+            ]
+        )
+        with pq.ParquetWriter(exportfile, schema) as writer:
+            for batch in batched(rows, batch_rows):
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+        return count
+    with open(exportfile, "w") as file:
+        for batch in batched(rows, batch_rows):
+            file.write("".join(json.dumps(row) + "\n" for row in batch))
+            count += len(batch)
+    return count
+
+
+def prune_index_dir(keep=INDEX_KEEP):
+    """
+    Drop the least recently used sidecars so ~/.parselog/index stays bounded.
+
+    Other parselog.py processes may prune at the same time, so sidecars that
+    are already gone are skipped.
+    """
+    entries = []
+    for entry in os.scandir(INDEX_DIR):
+        if entry.name.endswith(".idx"):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+    entries.sort(reverse=True)
+    for _, path in entries[keep:]:
+        logger.debug("removing stale index {}".format(path))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def write_indexed_hosts(index_path, inputfile, path_for, block_filter, touch, hosts):
+    """Worker for ``demux_indexed``: write ``hosts`` from the sidecar at ``index_path``."""
+    index = LogIndex.read(index_path)
+    writers = HostWriterPool(path_for)
+    try:
+        with mapped(inputfile) as mm:
+            for host in hosts:
+                index.write_host(mm, host, writers, block_filter, touch)
+    finally:
+        writers.close()
+    return writers.created
+
+
+def demux_indexed(
+    inputfile,
+    writers,
+    hostnames=None,
+    block_filter=NO_FILTER,
+    jobs=1,
+    keep_index=True,
+    stats=None,
+):
+    """
+    Same output as ``demux`` but served from the byte-offset index.
+
+    A missing index is built first. With ``jobs > 1`` both the scan and the
+    per-host writes are spread over a process pool. ``keep_index=False``
+    builds a throwaway sidecar instead of using ``INDEX_DIR``. ``stats`` is
+    filled from the index, as ``demux`` would fill it.
+    """
+    index = LogIndex.load(inputfile) if keep_index else None
+    if index is None:
+        scratch = None
+        if not keep_index:
+            fd, scratch = tempfile.mkstemp(prefix="parselog.", suffix=".idx")
+            os.close(fd)
+        index = LogIndex.build(inputfile, jobs, scratch)
+    else:
+        logger.debug("using index {}".format(index.path))
+    wanted = index.confirmed if hostnames is None else set(hostnames)
+    hosts = sorted(wanted)
+    # As in demux, -a with a narrowing filter skips hosts with nothing selected.
+    touch = hostnames is not None or not block_filter.narrows
+    try:
+        if jobs > 1 and len(hosts) > 1:
+            batch = max(1, len(hosts) // (jobs * CHUNKS_PER_JOB))
+            batches = [hosts[i : i + batch] for i in range(0, len(hosts), batch)]
+            worker = partial(
+                write_indexed_hosts,
+                index.path,
+                inputfile,
+                writers.path_for,
+                block_filter,
+                touch,
+            )
+            written = set()
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                for created in pool.map(worker, batches):
+                    written |= created
+        else:
+            with mapped(inputfile) as mm:
+                for host in hosts:
+                    index.write_host(mm, host, writers, block_filter, touch)
+            written = writers.created
+        if not touch:
+            wanted = wanted & written
+        if stats is not None:
+            with mapped(inputfile) as mm:
+                index.collect_stats(mm, stats, hosts, block_filter)
+    finally:
+        writers.close()
+        if not keep_index:
+            os.remove(index.path)
+    return wanted
+
+
+def follow_lines(
+    inputfile, stop=FOLLOW_STOP_KEYWORD, poll_interval=FOLLOW_POLL_SECONDS
+):
+    """
+    Yield the lines of a growing log as they are appended, like ``tail -f``.
+
+    Only complete lines are yielded. Once a line containing ``stop`` has been
+    read, whatever the file already holds is read too and the generator ends.
+    """
+    offset = 0
+    partial_line = b""
+    stopping = False
+    with open(inputfile, "rb") as file:
+        while True:
+            data = file.read(FOLLOW_READ_BYTES)
+            if not data:
+                if stopping:
+                    break
+                if os.fstat(file.fileno()).st_size < offset:
+                    logger.warning("{} was truncated, stopping".format(inputfile))
+                    break
+                time.sleep(poll_interval)
+                continue
+            offset += len(data)
+            complete, newline, partial_line = (partial_line + data).rpartition(b"\n")
+            if not newline:
+                # rpartition left the whole unterminated line in partial_line.
+                continue
+            for line in io.StringIO(decode_log_bytes(complete + newline)):
+                if stop in line:
+                    stopping = True
+                yield line
+    if partial_line:
+        yield decode_log_bytes(partial_line)
+
+
+def chunk_lines(chunks):
+    """Yield decoded lines from byte chunks that may split lines anywhere."""
+    partial_line = b""
+    for chunk in chunks:
+        complete, newline, partial_line = (partial_line + chunk).rpartition(b"\n")
+        if not newline:
+            continue
+        yield from io.StringIO(decode_log_bytes(complete + newline))
+    if partial_line:
+        yield decode_log_bytes(partial_line)
+
+
+def job_stdout_chunks(
+    job_id, token, jobs_url=AAP_JOBS_URL, chunk_bytes=JOB_STDOUT_CHUNK_BYTES
+):
+    """
+    Stream AAP job ``job_id``'s ``txt_download`` stdout as byte chunks.
+
+    The body is never held whole: each chunk is yielded as it arrives.
+    """
+    try:
+        import requests
+        from urllib3.exceptions import InsecureRequestWarning
+    except ImportError:
+        raise ImportError("--job-id needs the requests package") from None
+    requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
+
+    url = "{}{}/stdout/".format(jobs_url, job_id)
+    logger.debug("streaming {}".format(url))
+    with requests.get(
+        url,
+        headers={"Authorization": f"Bearer {token}"},
+        params={"format": "txt_download"},
+        stream=True,
+        verify=False,
+        timeout=AAP_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        yield from response.iter_content(chunk_bytes)
+
+
+def tee_chunks(chunks, path):
+    """Pass ``chunks`` through while also writing them to ``path``."""
+    with open(path, "wb") as file:
+        for chunk in chunks:
+            file.write(chunk)
+            yield chunk
+
+
+class ThreadedReader(io.RawIOBase):
+    """Raw stream fed by a thread that reads ``source`` ahead into a bounded queue."""
+
+    def __init__(self, source, chunk_bytes=DECOMPRESS_CHUNK_BYTES):
+        self.source = source
+        self.chunk_bytes = chunk_bytes
+        self.chunks = queue.Queue(maxsize=DECOMPRESS_QUEUE_CHUNKS)
+        self.pending = memoryview(b"")
+        self.error = None
+        self.eof = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.stopping.is_set():
+                chunk = self.source.read(self.chunk_bytes)
+                if not chunk:
+                    break
+                self._put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def _put(self, item):
+        while not self.stopping.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            if self.eof:
+                return 0
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+                if self.error is not None:
+                    raise self.error
+                return 0
+            self.pending = memoryview(chunk)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopping.set()
+            self.thread.join()
+            self.source.close()
+        super().close()
+
+
+def is_compressed(inputfile):
+    return inputfile.endswith(COMPRESSED_SUFFIXES)
+
+
+def open_compressed(inputfile):
+    """Binary reader that decompresses a .gz, .xz or .zst log as it goes."""
+    if inputfile.endswith(".gz"):
+        return gzip.open(inputfile, "rb")
+    if inputfile.endswith(".xz"):
+        return lzma.open(inputfile, "rb")
+    try:
+        from compression import zstd
+
+        return zstd.open(inputfile, "rb")
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading .zst logs needs the zstandard package") from None
+    # Appended stdouts are several frames
+    return zstandard.ZstdDecompressor().stream_reader(
+        open(inputfile, "rb"), closefd=True, read_across_frames=True
+    )
+
+
+def open_log(inputfile):
+    """
+    Open a log for the line-by-line text path.
+
+    Compressed logs are streamed: decompression runs in a reader thread so it
+    overlaps with parsing, and memory stays at a few chunks.
+    """
+    if not is_compressed(inputfile):
+        return open(inputfile, "r", encoding="ASCII", errors="ignore")
+    return io.TextIOWrapper(
+        io.BufferedReader(ThreadedReader(open_compressed(inputfile))),
+        encoding="ASCII",
+        errors="ignore",
+    )
+
+
+def stream_records(lines, hostnames=None, block_filter=NO_FILTER, source=""):
+    """
+    Yield the rows of ``LogIndex.records`` from the event stream, task by task.
+
+    Offsets count the decoded text. A row waits until its task's
+    profile_tasks timing could have been read and, with ``hostnames=None``,
+    until its host is confirmed; rows of hosts never confirmed are dropped.
+    """
+    position = 0
+    line_offset = 0
+
+    def counted():
+        nonlocal position, line_offset
+        for line in lines:
+            line_offset = position
+            position += len(line)
+            yield line
+
+    stats = RunStats()
+    confirmed = set()
+    current = {}
+    own = {}
+    waiting = []
+    unconfirmed = {}
+
+    def finished(before):
+        ready = [row for row in waiting if row["task_number"] < before]
+        waiting[:] = [row for row in waiting if row["task_number"] >= before]
+        for host in [host for host in unconfirmed if host in confirmed]:
+            ready.extend(unconfirmed.pop(host))
+        for row in ready:
+            if hostnames is None and row["host"] not in confirmed:
+                unconfirmed.setdefault(row["host"], []).append(row)
+                continue
+            row["duration"] = stats.durations.get(row["task_number"])
+            yield row
+
+    for event in iter_events(counted(), hostnames, block_filter):
+        stats.add(event)
+        kind = type(event)
+        if kind is ResultLine:
+            for host in event.hosts:
+                # As own_spans: the record ends where another host's lines start.
+                if not own[host]:
+                    continue
+                if is_other_host_line(event.line, host):
+                    own[host] = False
+                    continue
+                row = current[host]
+                row["length"] += len(event.line)
+                row["changed"] = row["changed"] or CHANGED_TRUE in event.line
+        elif kind is HostResultStart:
+            if event.detailed:
+                confirmed.add(event.host)
+            if event.skipped:
+                continue
+            current[event.host] = {
+                "file": source,
+                "host": event.host,
+                "task_number": len(stats.task_names) - 1,
+                "task": stats.task_names[-1],
+                "status": event.status,
+                "changed": event.status == "changed",
+                "duration": None,
+                "offset": line_offset,
+                "length": 0,
+            }
+            own[event.host] = True
+        elif kind is HostResultEnd:
+            waiting.append(current.pop(event.host))
+        elif kind is TaskStart:
+            # The previous task's timing is on the line after this banner.
+            yield from finished(len(stats.task_names) - 2)
+    yield from finished(len(stats.task_names))
+
+
+def export_indexed(
+    inputfile, exportfile, hostnames=None, block_filter=NO_FILTER, jobs=1
+):
+    """Write one row per host block of ``inputfile`` to ``exportfile``."""
+    index = LogIndex.load(inputfile) or LogIndex.build(inputfile, jobs)
+    hosts = sorted(index.confirmed if hostnames is None else set(hostnames))
+    with mapped(inputfile) as mm:
+        count = write_export(
+            index.records(mm, hosts, block_filter, os.path.basename(inputfile)),
+            exportfile,
+        )
+    logger.debug("exported {} rows to {}".format(count, exportfile))
+    return count
+
+
+def export_file(
+    inputfile,
+    exportfile,
+    hostnames=None,
+    block_filter=NO_FILTER,
+    jobs=1,
+    use_index=True,
+):
+    """Export with the index if the log can be mapped, else by streaming it."""
+    if use_index and not is_compressed(inputfile):
+        return export_indexed(inputfile, exportfile, hostnames, block_filter, jobs)
+    logger.debug("streaming {} without the index".format(inputfile))
+    with open_log(inputfile) as file:
+        count = write_export(
+            stream_records(file, hostnames, block_filter, os.path.basename(inputfile)),
+            exportfile,
+        )
+    logger.debug("exported {} rows to {}".format(count, exportfile))
+    return count
+
+
+@dataclass(slots=True)
+class TaskDigest:
+    """One host's blocks for one task: their statuses, body hash and line spans."""
+
+    task: str
+    statuses: list
+    digest: object
+    spans: list
+
+
+@lru_cache(maxsize=None)
+def host_mask_pattern(host):
+    """``host`` as a whole name: not part of a longer name, path or FQDN."""
+    return re.compile(r"(?<![\w./-]){}(?![\w./-])".format(re.escape(host)))
+
+
+def diff_normalize(line, host=None):
+    """Mask per-run values, and ``host`` when two hosts are compared."""
+    line = DIFF_VOLATILE_PATTERN.sub(r'"\1": "..."', line)
+    if host is not None:
+        line = host_mask_pattern(host).sub("<host>", line)
+    return line
+
+
+def task_digests(lines, hostnames=None, block_filter=NO_FILTER, mask_hosts=False):
+    """
+    Hash each host's task bodies from the event stream in one pass.
+
+    Returns ``{host: [TaskDigest, ...]}`` in task order, with the hash in
+    ``digest`` and the ``(first, last)`` line numbers of each block in
+    ``spans`` so divergent bodies can be read back later. With
+    ``hostnames=None`` only the hosts ``-a`` would pick are kept.
+    """
+    tasks = {}
+    current = {}
+    confirmed = set()
+    task_lineno = 0
+    for event in iter_events(lines, hostnames, block_filter):
+        kind = type(event)
+        if kind is ResultLine:
+            for host in event.hosts:
+                if not is_other_host_line(event.line, host, exact=True):
+                    current[host].digest.update(
+                        diff_normalize(event.line, host if mask_hosts else None).encode(
+                            "ASCII"
+                        )
+                    )
+        elif kind is TaskStart:
+            task_lineno = event.lineno
+        elif kind is HostResultStart:
+            if event.detailed:
+                confirmed.add(event.host)
+            if event.skipped:
+                continue
+            entry = current.get(event.host)
+            if entry is None or entry.spans[-1][0] < task_lineno:
+                entry = current[event.host] = TaskDigest(
+                    task_name(event.task), [], hashlib.blake2b(digest_size=16), []
+                )
+                tasks.setdefault(event.host, []).append(entry)
+            entry.statuses.append(event.status)
+            entry.spans.append((event.lineno, event.lineno))
+        elif kind is HostResultEnd:
+            entry = current[event.host]
+            entry.spans[-1] = (entry.spans[-1][0], event.lineno)
+    for entries in tasks.values():
+        for entry in entries:
+            entry.digest = entry.digest.digest()
+    if hostnames is None:
+        tasks = {host: entries for host, entries in tasks.items() if host in confirmed}
+    return tasks
+
+
+def align_tasks(left, right):
+    """
+    Yield ``(left, right)`` pairs of TaskDigests that differ.
+
+    The two task sequences are aligned by task name; a task found on one side
+    only is paired with None. Aligned tasks with the same hash are skipped.
+    """
+    matcher = difflib.SequenceMatcher(
+        None,
+        [entry.task for entry in left],
+        [entry.task for entry in right],
+        autojunk=False,
+    )
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for a, b in zip(left[i1:i2], right[j1:j2]):
+                if a.digest != b.digest or a.statuses != b.statuses:
+                    yield a, b
+            continue
+        for a in left[i1:i2]:
+            yield a, None
+        for b in right[j1:j2]:
+            yield None, b
+
+
+def read_spans(inputfile, wanted):
+    """Read back the block lines of ``wanted``, a ``{(host, span)}`` set, in one pass."""
+    starts = {}
+    for host, span in wanted:
+        starts.setdefault(span[0], []).append((host, span))
+    bodies = {key: [] for key in wanted}
+    open_spans = []
+    with open_log(inputfile) as file:
+        for lineno, line in enumerate(file, 1):
+            open_spans.extend(starts.pop(lineno, ()))
+            if not open_spans:
+                if not starts:
+                    break
+                continue
+            for host, span in open_spans:
+                if not is_other_host_line(line, host, exact=True):
+                    bodies[host, span].append(line)
+            open_spans = [(host, span) for host, span in open_spans if span[1] > lineno]
+    return bodies
+
+
+def diff_logs(inputfile, otherfile=None, hostnames=None, block_filter=NO_FILTER):
+    """
+    Print the tasks that differ between two hosts of one log or between two logs.
+
+    With ``otherfile`` the same hosts (``hostnames``, or every ``-a`` host of
+    either log) are compared across the logs; without it ``hostnames`` must
+    name the two hosts to compare. Only divergent tasks are read back and
+    printed, as unified diffs. Returns the number of divergent tasks.
+    """
+    if otherfile is None:
+        with open_log(inputfile) as file:
+            tasks = task_digests(file, hostnames, block_filter, mask_hosts=True)
+        pairs = [((inputfile, hostnames[0]), (inputfile, hostnames[1]), True)]
+        sides = {(inputfile, host): tasks.get(host, []) for host in hostnames}
+    else:
+        sides = {}
+        for name in (inputfile, otherfile):
+            with open_log(name) as file:
+                for host, entries in task_digests(
+                    file, hostnames, block_filter
+                ).items():
+                    sides[name, host] = entries
+        hosts = sorted({host for _, host in sides} if hostnames is None else hostnames)
+        pairs = [((inputfile, host), (otherfile, host), False) for host in hosts]
+
+    divergent = []
+    for left, right, mask_hosts in pairs:
+        for a, b in align_tasks(sides.get(left, []), sides.get(right, [])):
+            divergent.append((left, right, mask_hosts, a, b))
+    wanted = {}
+    for left, right, _, a, b in divergent:
+        for side, entry in ((left, a), (right, b)):
+            if entry is not None:
+                wanted.setdefault(side[0], set()).update(
+                    (side[1], span) for span in entry.spans
+                )
+    bodies = {name: read_spans(name, spans) for name, spans in wanted.items()}
+
+    def body(side, entry, mask_hosts):
+        if entry is None:
+            return []
+        return [
+            diff_normalize(line, side[1] if mask_hosts else None)
+            for span in entry.spans
+            for line in bodies[side[0]][side[1], span]
+        ]
+
+    for left, right, mask_hosts, a, b in divergent:
+        labels = [
+            "{} {}".format(os.path.basename(name), host) for name, host in (left, right)
+        ]
+        if b is None:
+            print("TASK [{}] only in {}".format(a.task, labels[0]))
+        elif a is None:
+            print("TASK [{}] only in {}".format(b.task, labels[1]))
+        else:
+            print(
+                "TASK [{}] {}: {} | {}: {}".format(
+                    a.task,
+                    labels[0],
+                    ",".join(a.statuses),
+                    labels[1],
+                    ",".join(b.statuses),
+                )
+            )
+        for line in difflib.unified_diff(
+            body(left, a, mask_hosts), body(right, b, mask_hosts), labels[0], labels[1]
+        ):
+            print(line, end="" if line.endswith("\n") else "\n")
+        print()
+    logger.debug("{} divergent tasks".format(len(divergent)))
+    return len(divergent)
+
+
+def examine_path(tempdir, inputfile, host):
+    if is_compressed(inputfile):
+        inputfile = os.path.splitext(inputfile)[0]
+    return os.path.join(tempdir, "examine-{}-{}".format(host, inputfile))
+
+
+def demux_file(
+    inputfile,
+    writers,
+    hostnames=None,
+    block_filter=NO_FILTER,
+    jobs=1,
+    use_index=True,
+    stats=None,
+    keep_index=True,
+):
+    """
+    Split one finished log with the index if it can be mapped, else by streaming it.
+
+    ``keep_index=False`` uses a throwaway sidecar even with ``use_index``.
+    """
+    seekable = stat.S_ISREG(os.stat(inputfile).st_mode) and not is_compressed(inputfile)
+    if (use_index or jobs > 1) and seekable:
+        return demux_indexed(
+            inputfile,
+            writers,
+            hostnames,
+            block_filter,
+            jobs=jobs,
+            keep_index=use_index and keep_index,
+            stats=stats,
+        )
+    logger.debug("streaming {} without the index".format(inputfile))
+    with open_log(inputfile) as file:
+        return demux(file, writers, hostnames, block_filter, stats=stats)
+
+
+def write_stats(stats, tempdir, inputfile):
+    """Write ``stats-<input>.json`` and the ``stats-<input>.txt`` table, and echo the table."""
+    inputfilebase = os.path.basename(inputfile).split(".")[0]
+    source = os.path.basename(inputfile)
+    with open(
+        os.path.join(tempdir, "stats-{}.json".format(inputfilebase)), "w"
+    ) as file:
+        json.dump(stats.as_dict(source), file, indent=2)
+    table = stats.table(source)
+    with open(os.path.join(tempdir, "stats-{}.txt".format(inputfilebase)), "w") as file:
+        file.write(table)
+    print(table, end="", file=sys.stderr)
+
+
+def fleet_logs(datadir):
+    """
+    The job logs in ``datadir``, oldest first.
+
+    AAP job ids grow with launch time, so ``job_<id>`` logs are ordered by id;
+    any other logs follow them in mtime order.
+    """
+
+    def age(path):
+        match = JOB_NUMBER_PATTERN.search(os.path.basename(path))
+        if match:
+            return (0, int(match.group(1)))
+        return (1, os.path.getmtime(path))
+
+    logs = []
+    for entry in os.scandir(datadir):
+        name = entry.name
+        if is_compressed(name):
+            name = os.path.splitext(name)[0]
+        if entry.is_file() and name.endswith(FLEET_LOG_SUFFIXES):
+            logs.append(entry.path)
+    return sorted(logs, key=age)
+
+
+def examine_fleet_log(partsdir, hostnames, block_filter, use_index, inputfile):
+    """
+    Worker for ``demux_fleet``: split one log into per-host parts under ``partsdir``.
+
+    The index is a throwaway sidecar: a fleet holds more logs than
+    ``INDEX_KEEP``, so keeping them would only evict every other sidecar.
+    """
+    start = time.perf_counter()
+    writers = HostWriterPool(
+        partial(examine_path, partsdir, os.path.basename(inputfile))
+    )
+    hosts = demux_file(
+        inputfile,
+        writers,
+        hostnames,
+        block_filter,
+        use_index=use_index,
+        keep_index=False,
+    )
+    return inputfile, hosts, time.perf_counter() - start
+
+
+def demux_fleet(
+    datadir, tempdir, hostnames=None, block_filter=NO_FILTER, jobs=1, use_index=True
+):
+    """
+    Collect each host's results from every job log in ``datadir``.
+
+    Logs are split in a pool of ``jobs`` processes, with a progress line on
+    stderr as each one finishes. Each host then gets ``history-<host>.txt`` in
+    ``tempdir``: its blocks from every job, oldest job first, each job under a
+    ``##### <log> #####`` header. Returns the hosts that got a history.
+    """
+    logs = fleet_logs(datadir)
+    partsdir = tempfile.mkdtemp(prefix=".parts.", dir=tempdir)
+    worker = partial(examine_fleet_log, partsdir, hostnames, block_filter, use_index)
+    found = {}
+    queued = iter(logs)
+    pending = set()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            for inputfile in islice(
+                queued, jobs * FLEET_PENDING_PER_JOB - len(pending)
+            ):
+                pending.add(pool.submit(worker, inputfile))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                inputfile, hosts, elapsed = future.result()
+                found[inputfile] = hosts
+                print(
+                    "[{}/{}] {}: {} hosts in {:.2f}s".format(
+                        len(found),
+                        len(logs),
+                        os.path.basename(inputfile),
+                        len(hosts),
+                        elapsed,
+                    ),
+                    file=sys.stderr,
+                    flush=True,
+                )
+
+    histories = HostWriterPool(
+        lambda host: os.path.join(tempdir, "history-{}.txt".format(host))
+    )
+    try:
+        for inputfile in logs:
+            name = os.path.basename(inputfile)
+            for host in sorted(found[inputfile]):
+                part = examine_path(partsdir, name, host)
+                if os.path.getsize(part):
+                    histories.write(
+                        host, "##### {} #####\n".format(name).encode("ASCII")
+                    )
+                    with open(part, "rb") as file:
+                        for chunk in iter(partial(file.read, 1 << 20), b""):
+                            histories.write(host, chunk)
+                os.remove(part)
+        for host in hostnames or ():
+            histories.touch(host)
+    finally:
+        histories.close()
+    os.rmdir(partsdir)
+    return histories.created
 
 
 def main(options):
@@ -39,10 +2012,21 @@ def main(options):
     inputfile = options.inputfile
     skip_skipped = options.skip_skipped
     all_hosts = options.all_hosts
+    use_index = options.use_index
+    jobs = options.jobs
+    follow = options.follow
+    stop_keyword = options.stop_keyword
+    exportfile = options.exportfile
+    datadir = options.datadir
+    job_id = options.job_id
+    stats = RunStats() if options.stats else None
+    difffile = options.difffile
+    block_filter = BlockFilter.from_options(
+        skip_skipped, options.statuses, options.task, options.exclude_task
+    )
 
     logdir = os.path.join(os.path.expanduser("~"), ".parselog")
     os.makedirs(logdir, exist_ok=True)
-    logger = logging.getLogger(__name__)
     formatter = logging.Formatter(
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
@@ -56,6 +2040,16 @@ def main(options):
     logger.debug("inputfile: {}".format(inputfile))
     logger.debug("skip_skipped: {}".format(skip_skipped))
     logger.debug("all_hosts: {}".format(all_hosts))
+    logger.debug("use_index: {}".format(use_index))
+    logger.debug("jobs: {}".format(jobs))
+    logger.debug("follow: {}".format(follow))
+    logger.debug("stop_keyword: {}".format(stop_keyword))
+    logger.debug("exportfile: {}".format(exportfile))
+    logger.debug("datadir: {}".format(datadir))
+    logger.debug("job_id: {}".format(job_id))
+    logger.debug("stats: {}".format(options.stats))
+    logger.debug("difffile: {}".format(difffile))
+    logger.debug("block_filter: {}".format(block_filter))
     logger.debug("verbose: {}".format(verbose))
 
     assert len(hostnames) > 0 or all_hosts, (
@@ -64,66 +2058,128 @@ def main(options):
     assert not (len(hostnames) > 0 and all_hosts), (
         "Cannot specify both hostnames and --all"
     )
-    assert inputfile, "Must specify an input file"
+    assert [bool(inputfile), bool(datadir), job_id is not None].count(True) == 1, (
+        "Must specify exactly one of an input file, --dir or --job-id"
+    )
+    assert job_id is None or not (follow or exportfile or difffile is not None), (
+        "--job-id cannot be combined with --follow, --export or --diff"
+    )
+    assert not (datadir and (follow or exportfile or difffile is not None)), (
+        "--dir cannot be combined with --follow, --export or --diff"
+    )
+    assert stats is None or not (datadir or exportfile or difffile is not None), (
+        "--stats cannot be combined with --dir, --export or --diff"
+    )
+
+    if datadir:
+        tempdir = tempfile.mkdtemp(
+            prefix=f"{os.path.basename(os.path.normpath(datadir))}.",
+            suffix=".tmpdir",
+            dir=".",
+        )
+        logger.debug("tempdir: {}".format(tempdir))
+        hostnames = demux_fleet(
+            datadir,
+            tempdir,
+            None if all_hosts else hostnames,
+            block_filter,
+            jobs=jobs,
+            use_index=use_index,
+        )
+        logger.debug("hosts written: {}".format(len(hostnames)))
+        print(tempdir)
+        return
+    if job_id is not None:
+        token = os.getenv(AAP_TOKEN_ENV)
+        assert token, "Environment variable {} is not set".format(AAP_TOKEN_ENV)
+        # Named like the files aap_leak_check.py downloads.
+        inputfile = "job_{}.txt".format(job_id)
+    assert not (follow and is_compressed(inputfile)), "Cannot follow a compressed file"
 
-    all_hosts_pattern = r"^\w+: \[([\S]+?)\] =>"
-    with open(inputfile, "r", encoding="ASCII", errors="ignore") as file:
-        inputfile_contents = file.read()
-    if all_hosts:
-        found_hosts = re.findall(all_hosts_pattern, inputfile_contents, re.MULTILINE)
-        hostnames = set(found_hosts)
+    assert difffile is None or not (follow or exportfile), (
+        "--diff cannot be combined with --follow or --export"
+    )
+    assert difffile is None or difffile or len(hostnames) == 2, (
+        "--diff without a second file needs exactly two -n hostnames"
+    )
+
+    if difffile is not None:
+        diff_logs(
+            inputfile, difffile or None, None if all_hosts else hostnames, block_filter
+        )
+        return
+
+    if exportfile:
+        export_file(
+            inputfile,
+            exportfile,
+            None if all_hosts else hostnames,
+            block_filter,
+            jobs,
+            use_index,
+        )
+        print(exportfile)
+        return
 
     # Create a temporary directory
     inputfilebase = os.path.basename(inputfile).split(".")[0]
     tempdir = tempfile.mkdtemp(prefix=f"{inputfilebase}.", suffix=".tmpdir", dir=".")
     logger.debug("tempdir: {}".format(tempdir))
 
-    for inventory_hostname in hostnames:
-        logger.debug("inventory_hostname: {}".format(inventory_hostname))
-        if skip_skipped:
-            host_pattern = re.compile(
-                rf"\b(?!skipping\b)[a-z]+\b: \[{re.escape(inventory_hostname)}\]"
+    writers = HostWriterPool(partial(examine_path, tempdir, inputfile))
+    wanted = None if all_hosts else hostnames
+    if follow:
+        # Print the directory up front so the files can be watched as they fill.
+        print(tempdir, flush=True)
+        try:
+            hostnames = demux(
+                follow_lines(inputfile, stop_keyword),
+                writers,
+                wanted,
+                block_filter,
+                flush=True,
+                stats=stats,
             )
-        else:
-            host_pattern = re.compile(rf"\w+: \[{re.escape(inventory_hostname)}\]")
-        task_pattern = re.compile(r"TASK")
-        close_brace_pattern = re.compile(r"\}\s*$")
-        other_host_pattern = re.compile(rf"\w+: \[(?!{inventory_hostname})[\S]+]")
-        empty_line_pattern = re.compile(r"^\s*$")
-        printing = False
-        check_nextline_blank = False
-        latest_task = ""
-        outputlist = []
-
-        with open(inputfile, "r", encoding="ASCII", errors="ignore") as file:
-            for line in file:
-                if task_pattern.match(line):
-                    printing = False
-                    latest_task = line
-                if host_pattern.match(line):
-                    printing = True
-                    outputlist.append("\n")
-                    outputlist.append(latest_task)
-                if printing:
-                    outputlist.append(line)
-                if close_brace_pattern.match(line):
-                    printing = False
-                if close_brace_pattern.search(line):
-                    check_nextline_blank = True
-                if empty_line_pattern.match(line):
-                    if check_nextline_blank:
-                        printing = False
-                        check_nextline_blank = False
-
-        logger.debug("length of outputlist: {}".format(len(outputlist)))
-        outputfile = os.path.join(
-            tempdir, "examine-{}-{}".format(inventory_hostname, inputfile)
-        )
-        logger.debug("outputfile: {}".format(outputfile))
-        with open(outputfile, "w") as file:
-            for line in outputlist:
-                if not other_host_pattern.match(line):
-                    file.write(line)
+        except KeyboardInterrupt:
+            writers.close()
+            hostnames = writers.created
+        logger.debug("hosts written: {}".format(len(hostnames)))
+        if stats is not None:
+            write_stats(stats, tempdir, inputfile)
+        return
+    if job_id is not None:
+        # The raw log is saved next to the per-host files as it streams past.
+        chunks = job_stdout_chunks(job_id, token, options.aap_url)
+        try:
+            hostnames = demux(
+                chunk_lines(tee_chunks(chunks, os.path.join(tempdir, inputfile))),
+                writers,
+                wanted,
+                block_filter,
+                stats=stats,
+            )
+        except OSError as e:  # requests' errors, e.g. a 404 for the job, are OSErrors
+            writers.close()
+            shutil.rmtree(tempdir, ignore_errors=True)
+            logger.error("streaming job {} failed: {}".format(job_id, e))
+            sys.exit("Cannot stream job {}: {}".format(job_id, e))
+        logger.debug("hosts written: {}".format(len(hostnames)))
+        if stats is not None:
+            write_stats(stats, tempdir, inputfile)
+        print(tempdir)
+        return
+    hostnames = demux_file(
+        inputfile,
+        writers,
+        wanted,
+        block_filter,
+        jobs=jobs,
+        use_index=use_index,
+        stats=stats,
+    )
+    logger.debug("hosts written: {}".format(len(hostnames)))
+    if stats is not None:
+        write_stats(stats, tempdir, inputfile)
 
     print(tempdir)
 
@@ -138,6 +2194,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "-n",
         "--hostname",
+        "--host",
         dest="hostnames",
         action="append",
         default=[],
@@ -151,7 +2208,29 @@ if __name__ == "__main__":
         default=False,
         help="Match all hosts",
     )
-    parser.add_argument("-f", "--file", dest="inputfile", help="Input file to process")
+    parser.add_argument(
+        "-f",
+        "--file",
+        dest="inputfile",
+        help="Input file to process (may be .gz, .xz or .zst)",
+    )
+    parser.add_argument(
+        "--job-id",
+        dest="job_id",
+        type=int,
+        help="Stream this AAP job's stdout from the API instead of reading a file",
+    )
+    parser.add_argument(
+        "--aap-url",
+        dest="aap_url",
+        default=AAP_JOBS_URL,
+        help="AAP jobs API URL for --job-id (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dir",
+        dest="datadir",
+        help="Process every job log in this directory into per-host histories",
+    )
     parser.add_argument(
         "-s",
         "--no-skipped",
@@ -160,6 +2239,68 @@ if __name__ == "__main__":
         default=False,
         help="Don't print skipped tasks",
     )
+    parser.add_argument(
+        "--status",
+        dest="statuses",
+        help="Only print results with these comma-separated statuses (failed also matches fatal)",
+    )
+    parser.add_argument(
+        "--task",
+        dest="task",
+        help="Only print tasks whose name matches this regular expression",
+    )
+    parser.add_argument(
+        "--exclude-task",
+        dest="exclude_task",
+        help="Don't print tasks whose name matches this regular expression",
+    )
+    parser.add_argument(
+        "--no-index",
+        dest="use_index",
+        action="store_false",
+        default=True,
+        help="Don't build or use the byte-offset index in ~/.parselog/index",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Worker processes for scanning and writing large files",
+    )
+    parser.add_argument(
+        "--export",
+        dest="exportfile",
+        help="Write one record per host task to this .jsonl or .parquet file instead",
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        default=False,
+        help="Also write PLAY RECAP counters and profile_tasks timings to stats-* files",
+    )
+    parser.add_argument(
+        "--diff",
+        dest="difffile",
+        nargs="?",
+        const="",
+        help="Print the tasks that differ between the two -n hosts, or between INPUTFILE and this log",
+    )
+    parser.add_argument(
+        "--follow",
+        dest="follow",
+        action="store_true",
+        default=False,
+        help="Keep reading the file as it grows until the stop keyword appears",
+    )
+    parser.add_argument(
+        "--stop",
+        dest="stop_keyword",
+        default=FOLLOW_STOP_KEYWORD,
+        help="Keyword that ends --follow (default: %(default)s)",
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -178,5 +2319,7 @@ if __name__ == "__main__":
     )
 
     options = parser.parse_args()
+    if options.exportfile and options.follow:
+        parser.error("--export needs a complete file and cannot follow one")
 
     main(options)
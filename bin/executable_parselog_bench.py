@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+"""
+parselog_bench.py - Throughput benchmark for parselog.py
+Description:
+    Generates deterministic synthetic AAP job logs (the same seed and settings always give the same bytes)
+    and times parselog's -a, -n and -s modes on both the text-mode single pass and the byte-level mmap path
+    (index build plus per-host writes) at several sizes, reporting seconds, MB/s, lines/s and peak RSS.
+    Each run happens in a fresh process so its peak RSS is its own; the mmap path counts the mapped pages
+    it touched. Results are saved to a JSON file, and --compare prints the speed ratio against an earlier one.
+    Expects parselog.py next to it, as installed in ~/bin.
+Usage:
+    parselog_bench.py [--sizes MB[,MB]] [--hosts N] [--tasks N] [--skipped-ratio R] [--body-bytes N]
+                      [--modes all,host,skipped] [--paths text,bytes] [--seed N] [-o RESULTS] [--compare OLD]
+    parselog_bench.py -f INPUTFILE [--modes ...] [--paths ...]
+    parselog_bench.py --generate LOGFILE [--sizes MB] [--hosts N] [--tasks N] [--skipped-ratio R] [--body-bytes N]
+    parselog_bench.py -h
+Options:
+    -h, --help            show this help message and exit
+    --sizes MB[,MB]       Sizes of the generated logs in MB (default 10,100,1024)
+    --hosts N             Number of hosts in the generated logs (default 300)
+    --tasks N             Distinct tasks in the generated play, repeated until the size is reached (default 40)
+    --skipped-ratio R     Fraction of results that are skipping (default 0.3)
+    --body-bytes N        Average size of a result's JSON body in bytes (default 600)
+    --seed N              Random seed for the generated logs (default 0)
+    --modes MODES         Comma-separated parselog modes: all (-a), host (-n), skipped (-a -s)
+    --paths PATHS         Comma-separated parsing paths: text, bytes
+    -f INPUTFILE, --file INPUTFILE
+                          Benchmark an existing log instead of generating them
+    --generate LOGFILE    Only write a generated log (of the first size) and exit
+    -o RESULTS, --output RESULTS
+                          Results file (default parselog_bench-<timestamp>.json)
+    --compare OLD         Print the speedup of each run against this earlier results file
+    --keep                Keep the generated logs and output directories
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import parselog
+
+MODES = ("all", "host", "skipped")
+PATHS = ("text", "bytes")
+STATUS_WEIGHTS = (("ok", 0.55), ("changed", 0.35), ("fatal", 0.05), ("failed", 0.05))
+
+
+def generate_log(
+    path,
+    size_mb,
+    hosts,
+    seed=0,
+    tasks=40,
+    skipped_ratio=0.3,
+    body_bytes=600,
+):
+    """
+    Write a deterministic AAP-style job log of roughly ``size_mb`` MB to ``path``.
+
+    The play cycles through ``tasks`` task names until the size is reached,
+    with a profile_tasks line after every banner giving, as the callback does,
+    the previous task's duration and the total so far. ``skipped_ratio`` of the
+    results are ``skipping`` one-liners; the rest are ok, changed or failed
+    with a JSON body of about ``body_bytes`` (half to one and a half times).
+    It ends with a PLAY RECAP that matches the results. Returns bytes written.
+    """
+    rng = random.Random(seed)
+    hostnames = ["host{:04d}.example.com".format(i) for i in range(hosts)]
+    task_names = ["synthetic : task {}".format(i) for i in range(tasks)]
+    statuses = [status for status, _ in STATUS_WEIGHTS]
+    weights = [weight for _, weight in STATUS_WEIGHTS]
+    recap = {
+        host: dict.fromkeys(("ok", "changed", "failed", "skipped"), 0)
+        for host in hostnames
+    }
+    target = size_mb * 1024 * 1024
+    written = 0
+    task = 0
+    previous = 0.0
+    elapsed = 0.0
+    with open(path, "w") as file:
+        written += file.write("PLAY [Synthetic play] " + "*" * 60 + "\n")
+        while written < target:
+            seconds = rng.uniform(0.1, 30.0)
+            lines = [
+                "\nTASK [{}] {}\n".format(task_names[task % tasks], "*" * 50),
+                "Monday 01 January 2024  10:00:00 +0000 ({}) {:>14} {}\n".format(
+                    timedelta_text(previous), timedelta_text(elapsed), "*" * 20
+                ),
+            ]
+            task += 1
+            previous = seconds
+            elapsed += seconds
+            for host in hostnames:
+                if rng.random() < skipped_ratio:
+                    recap[host]["skipped"] += 1
+                    lines.append(
+                        'skipping: [{}] => {{"changed": false, "skip_reason": '
+                        '"Conditional result was False"}}\n'.format(host)
+                    )
+                    continue
+                status = rng.choices(statuses, weights)[0]
+                recap[host]["failed" if status in ("fatal", "failed") else status] += 1
+                if status == "changed":
+                    recap[host]["ok"] += 1
+                if status == "fatal":
+                    lines.append("fatal: [{}]: FAILED! => {{\n".format(host))
+                else:
+                    lines.append("{}: [{}] => {{\n".format(status, host))
+                lines.append(
+                    '    "changed": {},\n'.format(str(status == "changed").lower())
+                )
+                lines.append('    "stdout_lines": [\n')
+                size = rng.randint(body_bytes // 2, body_bytes * 3 // 2)
+                body = 0
+                line = 0
+                while body < size:
+                    text = '        "{} line {} {:08x}",\n'.format(
+                        host, line, rng.getrandbits(32)
+                    )
+                    lines.append(text)
+                    body += len(text)
+                    line += 1
+                lines.append("    ]\n}\n")
+            written += file.write("".join(lines))
+        written += file.write("\nPLAY RECAP " + "*" * 60 + "\n")
+        for host in hostnames:
+            written += file.write(
+                "{:<26}: ok={}    changed={}    unreachable=0    failed={}    "
+                "skipped={}    rescued=0    ignored=0\n".format(
+                    host,
+                    recap[host]["ok"],
+                    recap[host]["changed"],
+                    recap[host]["failed"],
+                    recap[host]["skipped"],
+                )
+            )
+        # The last task's duration follows the recap
+        written += file.write(
+            "\nMonday 01 January 2024  10:00:00 +0000 ({}) {:>14} {}\n".format(
+                timedelta_text(previous), timedelta_text(elapsed), "*" * 20
+            )
+        )
+    return written
+
+
+def timedelta_text(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return "{}:{:02d}:{:06.3f}".format(hours, minutes, seconds)
+
+
+def count_lines(inputfile):
+    lines = 0
+    with open(inputfile, "rb") as file:
+        for chunk in iter(partial(file.read, 1 << 24), b""):
+            lines += chunk.count(b"\n")
+    return lines
+
+
+def run_mode(inputfile, outdir, path, mode, host):
+    """Run one benchmark in this (fresh) process; return seconds, peak RSS and hosts written."""
+    writers = parselog.HostWriterPool(partial(parselog.examine_path, outdir, "bench"))
+    hostnames = [host] if mode == "host" else None
+    block_filter = parselog.BlockFilter(skip_skipped=mode == "skipped")
+    start = time.perf_counter()
+    if path == "text":
+        with open(inputfile, "r", encoding="ASCII", errors="ignore") as file:
+            written = parselog.demux(file, writers, hostnames, block_filter)
+    else:
+        written = parselog.demux_indexed(
+            inputfile, writers, hostnames, block_filter, keep_index=False
+        )
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    return (
+        elapsed,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        len(written),
+    )
+
+
+def first_host(inputfile):
+    with open(inputfile, "r", encoding="ASCII", errors="ignore") as file:
+        for event in parselog.iter_events(file):
+            if type(event) is parselog.HostResultStart and event.detailed:
+                return event.host
+    return None
+
+
+def bench_log(inputfile, workdir, modes, paths, label):
+    """Time every mode and path on ``inputfile``, each in its own spawned process."""
+    size_mb = os.path.getsize(inputfile) / (1024 * 1024)
+    lines = count_lines(inputfile)
+    host = first_host(inputfile)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for path in paths:
+        for mode in modes:
+            outdir = tempfile.mkdtemp(prefix="{}.{}.".format(path, mode), dir=workdir)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                elapsed, peak_rss_mb, hosts = pool.submit(
+                    run_mode, inputfile, outdir, path, mode, host
+                ).result()
+            shutil.rmtree(outdir)
+            result = {
+                "log": label,
+                "size_mb": round(size_mb, 1),
+                "lines": lines,
+                "path": path,
+                "mode": mode,
+                "seconds": round(elapsed, 3),
+                "mb_per_s": round(size_mb / elapsed, 1),
+                "lines_per_s": round(lines / elapsed),
+                "peak_rss_mb": round(peak_rss_mb, 1),
+                "hosts_written": hosts,
+            }
+            results.append(result)
+            print(
+                "{log:<14} {path:<6} {mode:<8} {seconds:8.2f}s {mb_per_s:8.1f} MB/s "
+                "{lines_per_s:>11,} lines/s {peak_rss_mb:8.1f} MB RSS".format(**result),
+                flush=True,
+            )
+    return results
+
+
+def compare(results, oldfile):
+    with open(oldfile) as file:
+        old = {
+            (result["log"], result["path"], result["mode"]): result
+            for result in json.load(file)["results"]
+        }
+    for result in results:
+        before = old.get((result["log"], result["path"], result["mode"]))
+        if before is None:
+            continue
+        print(
+            "{:<14} {:<6} {:<8} {:6.2f}x speed {:6.2f}x RSS".format(
+                result["log"],
+                result["path"],
+                result["mode"],
+                before["seconds"] / result["seconds"],
+                result["peak_rss_mb"] / before["peak_rss_mb"],
+            )
+        )
+
+
+def main(options):
+    sizes = [int(size) for size in options.sizes.split(",")]
+    modes = options.modes.split(",")
+    paths = options.paths.split(",")
+    assert set(modes) <= set(MODES), "Modes must be among {}".format(",".join(MODES))
+    assert set(paths) <= set(PATHS), "Paths must be among {}".format(",".join(PATHS))
+    generate = partial(
+        generate_log,
+        hosts=options.hosts,
+        seed=options.seed,
+        tasks=options.tasks,
+        skipped_ratio=options.skipped_ratio,
+        body_bytes=options.body_bytes,
+    )
+    if options.generate:
+        generate(options.generate, sizes[0])
+        print(options.generate)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="parselog_bench.")
+    results = []
+    try:
+        if options.inputfile:
+            logs = [(options.inputfile, os.path.basename(options.inputfile))]
+        else:
+            logs = []
+            for size in sizes:
+                inputfile = os.path.join(workdir, "job_bench_{}mb.txt".format(size))
+                start = time.perf_counter()
+                generate(inputfile, size)
+                print(
+                    "generated {} in {:.1f}s".format(
+                        inputfile, time.perf_counter() - start
+                    )
+                )
+                logs.append((inputfile, "{}MB".format(size)))
+        for inputfile, label in logs:
+            results += bench_log(inputfile, workdir, modes, paths, label)
+            if not options.inputfile and not options.keep:
+                os.remove(inputfile)
+    finally:
+        if options.keep:
+            print("kept {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    output = options.output or "parselog_bench-{}.json".format(
+        time.strftime("%Y%m%d-%H%M%S")
+    )
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "config": {
+                    "hosts": options.hosts,
+                    "tasks": options.tasks,
+                    "skipped_ratio": options.skipped_ratio,
+                    "body_bytes": options.body_bytes,
+                    "seed": options.seed,
+                    "inputfile": options.inputfile,
+                },
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print("results saved to {}".format(output))
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parselog.py parsing paths")
+    parser.add_argument(
+        "--sizes",
+        default="10,100,1024",
+        help="Comma-separated generated log sizes in MB",
+    )
+    parser.add_argument(
+        "--hosts", type=int, default=300, help="Hosts in the generated logs"
+    )
+    parser.add_argument(
+        "--tasks", type=int, default=40, help="Distinct tasks in the generated play"
+    )
+    parser.add_argument(
+        "--skipped-ratio",
+        dest="skipped_ratio",
+        type=float,
+        default=0.3,
+        help="Fraction of results that are skipping",
+    )
+    parser.add_argument(
+        "--body-bytes",
+        dest="body_bytes",
+        type=int,
+        default=600,
+        help="Average JSON body size of a result in bytes",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Random seed for the generated logs"
+    )
+    parser.add_argument(
+        "--modes",
+        default=",".join(MODES),
+        help="Comma-separated modes: all, host, skipped",
+    )
+    parser.add_argument(
+        "--paths",
+        default=",".join(PATHS),
+        help="Comma-separated parsing paths: text, bytes",
+    )
+    parser.add_argument(
+        "-f", "--file", dest="inputfile", help="Benchmark an existing log"
+    )
+    parser.add_argument("--generate", help="Only write a generated log to this file")
+    parser.add_argument("-o", "--output", help="Results JSON file")
+    parser.add_argument(
+        "--compare", help="Earlier results JSON file to compare against"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", default=False, help="Keep generated files"
+    )
+
+    options = parser.parse_args()
+
+    main(options)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+"""
+secret_scan.py - Scan job logs for leaked secrets
+Description:
+    Scans files (plain, or .gz/.xz/.zst job logs as written by aap_leak_check.py) for secrets such as
+    cloud keys, tokens, private keys and credentials in URIs, without an external scanner binary.
+    Every detector has literal keywords; one multi-pattern pass over each chunk of a file finds which
+    keywords occur (an Aho-Corasick automaton if the pyahocorasick package is installed, otherwise a
+    single alternation regex), and only those detectors' confirming regexes then run over the chunk.
+    Plain files are scanned as mmap'd buffers and compressed ones decompressed chunk by chunk, one
+    file per worker in a process pool.
+    Findings are written as a JSON list of path, line, detector, redacted secret, the SHA-256 of the
+    secret and a message, the shape aap_leak_check.py turns into its CSV.
+    With --cache, each file's findings are kept under the SHA-256 of its content, and only files whose
+    content is not in the cache are scanned; files are only rehashed when their size or mtime changed.
+    Expects parselog.py next to it, as installed in ~/bin.
+Usage:
+    secret_scan.py [-j JOBS] [-o OUTPUT] [--cache CACHE] PATH [PATH ...]
+    secret_scan.py -h
+Options:
+    -h, --help            show this help message and exit
+    -j JOBS, --jobs JOBS  Worker processes (default: number of CPUs)
+    -o OUTPUT, --output OUTPUT
+                          Write the findings JSON here instead of stdout
+    --cache CACHE         Scan cache file, created if missing
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import parselog
+
+# Files are scanned in chunks of SCAN_CHUNK_BYTES, each overlapping the next by
+# the longest possible match so no match is cut in two.
+SCAN_CHUNK_BYTES = 1 << 22
+# In-progress downloads
+SKIP_SUFFIXES = (".part",)
+# Bumped when the cache layout changes; cached findings are also dropped when
+# the detectors change
+CACHE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+# An empty match where no word character comes before, i.e. a word start
+WORD_START = re.compile(rb"(?<![0-9A-Za-z_])\Z")
+# The longest ``before`` match
+BEFORE_BYTES = 16
+
+
+@dataclass(slots=True, frozen=True)
+class Detector:
+    """
+    A secret type: literal ``keywords`` that every match contains and the ``pattern`` that confirms it.
+
+    Patterns start with a literal, which lets ``re`` skip ahead to it. If
+    ``before`` is set it has to match right up to the start of a match, and
+    the finding then starts where it did. No match is longer than ``span`` bytes.
+    """
+
+    name: str
+    keywords: tuple
+    pattern: re.Pattern
+    before: re.Pattern = None
+    span: int = 256
+
+
+DETECTORS = (
+    Detector(
+        "AWS",
+        (b"AKIA", b"ASIA"),
+        re.compile(rb"(?:AKIA|ASIA)[0-9A-Z]{16}\b"),
+        before=WORD_START,
+    ),
+    Detector(
+        "Github",
+        (b"ghp_", b"gho_", b"ghu_", b"ghs_", b"ghr_"),
+        re.compile(rb"gh[pousr]_[0-9A-Za-z]{36}\b"),
+        before=WORD_START,
+    ),
+    Detector(
+        "GithubFineGrained",
+        (b"github_pat_",),
+        re.compile(rb"github_pat_[0-9A-Za-z_]{82}\b"),
+        before=WORD_START,
+    ),
+    Detector(
+        "Gitlab",
+        (b"glpat-",),
+        re.compile(rb"glpat-[0-9A-Za-z_\-]{20}\b"),
+        before=WORD_START,
+    ),
+    Detector(
+        "Slack",
+        (b"xoxb-", b"xoxp-", b"xoxa-", b"xoxr-", b"xoxs-"),
+        re.compile(rb"xox[baprs]-[0-9A-Za-z\-]{10,72}"),
+        before=WORD_START,
+    ),
+    Detector(
+        "SlackWebhook",
+        (b"hooks.slack.com/services/",),
+        re.compile(
+            rb"https://hooks\.slack\.com/services/T[0-9A-Z]+/B[0-9A-Z]+/[0-9A-Za-z]{24}"
+        ),
+    ),
+    Detector(
+        "PrivateKey",
+        (b"PRIVATE KEY-----",),
+        re.compile(
+            rb"-----BEGIN (?:[A-Z]+ )*PRIVATE KEY-----[\s\S]{64,8192}?-----END (?:[A-Z]+ )*PRIVATE KEY-----"
+        ),
+        span=8400,
+    ),
+    Detector(
+        "GoogleApiKey",
+        (b"AIza",),
+        re.compile(rb"AIza[0-9A-Za-z_\-]{35}\b"),
+        before=WORD_START,
+    ),
+    Detector(
+        "Stripe",
+        (b"sk_live_", b"rk_live_"),
+        re.compile(rb"[rs]k_live_[0-9A-Za-z]{24,99}\b"),
+        before=WORD_START,
+    ),
+    Detector(
+        "SendGrid",
+        (b"SG.",),
+        re.compile(rb"SG\.[0-9A-Za-z_\-]{22}\.[0-9A-Za-z_\-]{43}\b"),
+        before=WORD_START,
+    ),
+    Detector(
+        "NpmToken", (b"npm_",), re.compile(rb"npm_[0-9A-Za-z]{36}\b"), before=WORD_START
+    ),
+    Detector(
+        "VaultToken",
+        (b"hvs.",),
+        re.compile(rb"hvs\.[0-9A-Za-z_\-]{24,}"),
+        before=WORD_START,
+    ),
+    Detector(
+        "JWT",
+        (b"eyJ",),
+        re.compile(
+            rb"eyJ[0-9A-Za-z_\-]{10,}\.eyJ[0-9A-Za-z_\-]{10,}\.[0-9A-Za-z_\-]{10,}"
+        ),
+        before=WORD_START,
+        span=4096,
+    ),
+    Detector(
+        "AzureStorage",
+        (b"AccountKey=",),
+        re.compile(rb"AccountKey=[0-9A-Za-z+/]{86}=="),
+    ),
+    Detector(
+        "URI",
+        (b"://",),
+        re.compile(
+            rb"\b[A-Za-z][A-Za-z0-9+.\-]{1,15}://[^\s:/@\"'\\]{1,64}:[^\s:/@\"'\\]{3,128}@[0-9A-Za-z.\-]+"
+        ),
+        span=512,
+    ),
+)
+
+
+class KeywordMatcher:
+    """Which detector keywords occur in a buffer, found in one pass."""
+
+    def __init__(self, detectors):
+        self.detectors = {}
+        for detector in detectors:
+            for keyword in detector.keywords:
+                self.detectors.setdefault(keyword, []).append(detector)
+        try:
+            import ahocorasick
+        except ImportError:
+            self.automaton = None
+            keywords = sorted(self.detectors, key=len, reverse=True)
+            self.pattern = re.compile(
+                b"|".join(re.escape(keyword) for keyword in keywords)
+            )
+        else:
+            # pyahocorasick works on str, so buffers are decoded as latin-1,
+            # which keeps one character per byte.
+            self.automaton = ahocorasick.Automaton()
+            for keyword in self.detectors:
+                self.automaton.add_word(keyword.decode("latin-1"), keyword)
+            self.automaton.make_automaton()
+
+    def present(self, buffer, start, end):
+        """Detectors with a keyword between ``start`` and ``end``."""
+        if self.automaton is None:
+            keywords = set(self.pattern.findall(buffer, start, end))
+        else:
+            text = buffer[start:end].decode("latin-1")
+            keywords = {keyword for _, keyword in self.automaton.iter(text)}
+        return {
+            detector for keyword in keywords for detector in self.detectors[keyword]
+        }
+
+
+_matcher = None
+
+
+def get_matcher():
+    global _matcher
+    if _matcher is None:
+        _matcher = KeywordMatcher(DETECTORS)
+    return _matcher
+
+
+def scan_buffer(buffer, start, end, limit):
+    """
+    Confirmed matches in ``buffer[start:end]`` starting before ``limit``, in order.
+
+    Only detectors whose keywords occur in the range run their regex over it.
+    """
+    found = []
+    for detector in get_matcher().present(buffer, start, end):
+        for match in detector.pattern.finditer(buffer, start, end):
+            begin = match.start()
+            if detector.before is not None:
+                before = detector.before.search(
+                    buffer, max(start, begin - BEFORE_BYTES), begin
+                )
+                if before is None:
+                    continue
+                begin = before.start()
+            if begin < limit:
+                found.append((begin, match.end(), detector))
+    return sorted(found, key=lambda item: item[0])
+
+
+def redact(secret):
+    """The first 4 characters of ``secret`` and up to 8 stars."""
+    return secret[:4] + "*" * min(8, max(0, len(secret) - 4))
+
+
+def finding(path, line, detector, raw):
+    redacted = redact(raw.decode("ASCII", errors="replace"))
+    return {
+        "path": path,
+        "line": line,
+        "detector": detector.name,
+        "redacted": redacted,
+        "raw_sha256": hashlib.sha256(raw).hexdigest(),
+        "message": f"{detector.name} secret found on line {line}: {redacted}",
+    }
+
+
+def scan_file(path):
+    """Scan one file and return its findings."""
+    # A match starting in the last ``overlap`` bytes of a chunk may run past
+    # it, so it is left for the next chunk, which starts with those bytes.
+    overlap = max(detector.span for detector in DETECTORS)
+    findings = []
+    line = 1
+    if not parselog.is_compressed(path):
+        with parselog.mapped(path) as mm:
+            last = 0
+            for start in range(0, len(mm), SCAN_CHUNK_BYTES):
+                limit = min(len(mm), start + SCAN_CHUNK_BYTES)
+                end = min(len(mm), limit + overlap)
+                for begin, stop, detector in scan_buffer(mm, start, end, limit):
+                    line += mm[last:begin].count(b"\n")
+                    last = begin
+                    findings.append(finding(path, line, detector, mm[begin:stop]))
+        return findings
+
+    tail = b""
+    with parselog.open_compressed(path) as file:
+        while True:
+            data = file.read(SCAN_CHUNK_BYTES)
+            buffer = tail + data
+            limit = max(0, len(buffer) - overlap) if data else len(buffer)
+            last = 0
+            for begin, stop, detector in scan_buffer(buffer, 0, len(buffer), limit):
+                line += buffer.count(b"\n", last, begin)
+                last = begin
+                findings.append(finding(path, line, detector, buffer[begin:stop]))
+            if not data:
+                return findings
+            line += buffer.count(b"\n", last, limit)
+            tail = buffer[limit:]
+
+
+def scan_files(paths):
+    """Regular files under ``paths`` (files or directories), largest first."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+    files = [
+        file
+        for file in files
+        if os.path.isfile(file) and not file.endswith(SKIP_SUFFIXES)
+    ]
+    return sorted(files, key=os.path.getsize, reverse=True)
+
+
+def file_hash(path):
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def detectors_hash():
+    """A digest of the detectors, so cached findings are dropped when they change."""
+    digest = hashlib.sha256()
+    for detector in DETECTORS:
+        before = detector.before.pattern if detector.before is not None else b""
+        digest.update(repr((detector.name, detector.pattern.pattern, before)).encode())
+    return digest.hexdigest()
+
+
+class ScanCache:
+    """
+    Findings kept under the SHA-256 of each file's content, with the size, mtime and hash of each path.
+
+    ``save`` keeps only the paths looked up or added since loading.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        try:
+            with open(cache) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            state = {}
+        if (
+            state.get("version") != CACHE_VERSION
+            or state.get("detectors") != detectors_hash()
+        ):
+            state = {
+                "version": CACHE_VERSION,
+                "detectors": detectors_hash(),
+                "files": {},
+                "findings": {},
+            }
+        self.state = state
+        self.files = {}
+
+    def lookup(self, path):
+        """Cached findings for ``path``, or ``None`` if it is new or changed since."""
+        stat = os.stat(path)
+        entry = self.state["files"].get(path)
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime_ns"] != stat.st_mtime_ns
+            or entry["sha256"] not in self.state["findings"]
+        ):
+            return None
+        self.files[path] = entry
+        return self.with_path(path, entry["sha256"])
+
+    def known(self, path, digest):
+        """Cached findings for ``path`` with content ``digest``, or ``None`` if it is new."""
+        if digest not in self.state["findings"]:
+            return None
+        return self.add(path, digest)
+
+    def add(self, path, digest, findings=None):
+        """Record ``path`` with content ``digest`` and its ``findings``; return them."""
+        stat = os.stat(path)
+        self.files[path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest,
+        }
+        if findings is not None:
+            self.state["findings"][digest] = [
+                {key: value for key, value in item.items() if key != "path"}
+                for item in findings
+            ]
+        return self.with_path(path, digest)
+
+    def with_path(self, path, digest):
+        return [{"path": path, **item} for item in self.state["findings"][digest]]
+
+    def save(self):
+        digests = {entry["sha256"] for entry in self.files.values()}
+        self.state["files"] = self.files
+        self.state["findings"] = {
+            digest: items
+            for digest, items in self.state["findings"].items()
+            if digest in digests
+        }
+        with open(f"{self.cache}.tmp", "w") as file:
+            json.dump(self.state, file)
+        os.replace(f"{self.cache}.tmp", self.cache)
+
+
+def hash_and_scan(path):
+    """The content hash and findings of one file, for a ``ScanCache``."""
+    return file_hash(path), scan_file(path)
+
+
+def pool_map(function, items, jobs):
+    """``function`` over ``items`` in a pool of ``jobs`` processes, results in order."""
+    if jobs == 1 or len(items) < 2:
+        return [function(item) for item in items]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(function, items))
+
+
+def scan_cached(files, jobs, cache):
+    """
+    Findings for ``files``, scanning only the ones whose content is not in ``cache``.
+
+    Files are only hashed when their size or mtime changed, and copies of the
+    same content are scanned once.
+    """
+    cache = ScanCache(cache)
+    findings = []
+    stale = []
+    for path in files:
+        if (cached := cache.lookup(path)) is None:
+            stale.append(path)
+        else:
+            findings.extend(cached)
+    unscanned = {}
+    for path, digest in zip(stale, pool_map(file_hash, stale, jobs)):
+        if (cached := cache.known(path, digest)) is None:
+            unscanned.setdefault(digest, []).append(path)
+        else:
+            findings.extend(cached)
+    scanned = pool_map(scan_file, [paths[0] for paths in unscanned.values()], jobs)
+    for (digest, paths), items in zip(unscanned.items(), scanned):
+        for path in paths:
+            findings.extend(cache.add(path, digest, items))
+    logger.info(
+        "scanned {} of {} files ({} rehashed)".format(
+            len(unscanned), len(files), len(stale)
+        )
+    )
+    cache.save()
+    return findings
+
+
+def scan_paths(paths, jobs=None, cache=None):
+    """
+    Scan every file under ``paths`` in a pool of ``jobs`` processes; return all findings.
+
+    With a ``cache`` file only new or changed files are scanned.
+    """
+    files = scan_files(paths)
+    jobs = jobs or os.cpu_count() or 1
+    if cache:
+        findings = scan_cached(files, jobs, cache)
+    else:
+        findings = [
+            item for items in pool_map(scan_file, files, jobs) for item in items
+        ]
+    return sorted(findings, key=lambda item: (item["path"], item["line"]))
+
+
+def main(options):
+    findings = scan_paths(options.paths, options.jobs, options.cache)
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(findings, file, indent=4)
+    else:
+        json.dump(findings, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan job logs for leaked secrets")
+    parser.add_argument("paths", nargs="+", help="Files or directories to scan")
+    parser.add_argument("-j", "--jobs", type=int, help="Worker processes")
+    parser.add_argument("-o", "--output", help="Findings JSON file")
+    parser.add_argument("--cache", help="Scan cache file")
+
+    options = parser.parse_args()
+
+    main(options)
@@ -27,7 +27,8 @@ template_ids = args.template_ids
 
 # Replace with your actual values
 bearer_token = os.getenv("BEARER_TOKEN")
-base_url = "https://mind-aap.marriott.com/api/v2"
+# AAP_BASE_URL points it elsewhere, e.g. at aap_mock.py
+base_url = os.getenv("AAP_BASE_URL", "https://mind-aap.marriott.com/api/v2").rstrip("/")
 organization_id = 1
 # template_ids = [694, 696, 1312, 697, 698, 1313]  # List of template IDs to update
 
@@ -12,7 +12,10 @@ requests.packages.urllib3.disable_warnings()
 
 bearer_token = os.getenv("BEARER_TOKEN")
 
-base_url = "https://mind-aap.marriott.com/api/v2/"
+# AAP_BASE_URL points it elsewhere, e.g. at aap_mock.py
+base_url = (
+    os.getenv("AAP_BASE_URL", "https://mind-aap.marriott.com/api/v2").rstrip("/") + "/"
+)
 
 
 def get_aap_objects(object_type):
@@ -0,0 +1,141 @@
+"""
+Tests for parselog.py: the streaming and the index paths must agree.
+
+Run with ``python -m pytest bin/test_parselog.py``; parselog.py is imported by
+its installed name in ~/bin, or from executable_parselog.py in the chezmoi
+source.
+"""
+
+import gzip
+import importlib.util
+import json
+import os
+
+import pytest
+
+try:
+    import parselog
+except ImportError:
+    spec = importlib.util.spec_from_file_location(
+        "parselog",
+        os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "executable_parselog.py"
+        ),
+    )
+    parselog = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(parselog)
+
+TIMING = "Monday 01 January 2024  10:00:00 +0000 ({}) {} ********************\n"
+
+DELEGATED_LOG = (
+    "PLAY [delegation] ***********************************************************\n"
+    "\n"
+    "TASK [first] ****************************************************************\n"
+    + TIMING.format("0:00:00.000", "0:00:00.000")
+    + 'ok: [web1] => {"changed": false}\n'
+    + 'ok: [web1 -> localhost] => {"changed": false}\n'
+    + 'changed: [web10] => {"changed": true}\n'
+    + "\n"
+    + "TASK [second] ***************************************************************\n"
+    + TIMING.format("0:00:03.000", "0:00:03.000")
+    + "changed: [web1 -> localhost] => {\n"
+    + '    "changed": true\n'
+    + "}\n"
+    + 'ok: [web10] => {"changed": false}\n'
+    + "\n"
+    + "PLAY RECAP ******************************************************************\n"
+    + "web1                       : ok=2    changed=1    unreachable=0    failed=0\n"
+    + "web10                      : ok=2    changed=1    unreachable=0    failed=0\n"
+    + "\n"
+    + TIMING.format("0:00:04.000", "0:00:07.000")
+)
+
+HANDLER_LOG = (
+    "PLAY [handlers] *************************************************************\n"
+    "\n"
+    "TASK [A] ********************************************************************\n"
+    + TIMING.format("0:00:00.000", "0:00:00.000")
+    + 'changed: [web1] => {"changed": true}\n'
+    + "\n"
+    + "RUNNING HANDLER [H] *********************************************************\n"
+    + TIMING.format("0:00:05.000", "0:00:05.000")
+    + 'changed: [web1] => {"changed": true}\n'
+    + "\n"
+    + "PLAY RECAP ******************************************************************\n"
+    + "web1                       : ok=2    changed=2    unreachable=0    failed=0\n"
+    + "\n"
+    + TIMING.format("0:01:40.000", "0:01:45.000")
+)
+
+
+@pytest.fixture(autouse=True)
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(parselog, "INDEX_DIR", str(tmp_path / "index"))
+
+
+def write_log(tmp_path, text, name="job_1.txt"):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def split_stats(tmp_path, inputfile, use_index):
+    out = tmp_path / ("indexed" if use_index else "streamed")
+    out.mkdir()
+    writers = parselog.HostWriterPool(lambda host: str(out / host))
+    stats = parselog.RunStats()
+    parselog.demux_file(inputfile, writers, use_index=use_index, stats=stats)
+    return stats.as_dict("log")
+
+
+def test_stats_agree_without_delegated_hosts(tmp_path):
+    inputfile = write_log(tmp_path, DELEGATED_LOG)
+    streamed = split_stats(tmp_path, inputfile, use_index=False)
+    indexed = split_stats(tmp_path, inputfile, use_index=True)
+    assert streamed == indexed
+    assert sorted(streamed["hosts"]) == ["web1", "web10"]
+    assert streamed["hosts"]["web1"]["task_seconds"] == 3.0
+
+
+def test_handler_is_timed_as_a_task(tmp_path):
+    inputfile = write_log(tmp_path, HANDLER_LOG)
+    streamed = split_stats(tmp_path, inputfile, use_index=False)
+    indexed = split_stats(tmp_path, inputfile, use_index=True)
+    assert streamed == indexed
+    totals = {entry["task"]: entry["total"] for entry in streamed["tasks"]}
+    assert totals == {"A": 5.0, "H": 100.0}
+    assert streamed["hosts"]["web1"]["task_seconds"] == 105.0
+
+
+def test_diff_keeps_web10_out_of_web1(tmp_path, capsys):
+    inputfile = write_log(tmp_path, DELEGATED_LOG)
+    otherfile = write_log(
+        tmp_path,
+        DELEGATED_LOG.replace(
+            'changed: [web10] => {"changed": true}', "failed: [web10]"
+        ),
+        name="job_2.txt",
+    )
+    assert parselog.diff_logs(inputfile, otherfile, ["web1"]) == 0
+    assert parselog.diff_logs(inputfile, otherfile, ["web10"]) == 1
+    assert "web1 " not in capsys.readouterr().out.replace("web10", "")
+
+
+def export_rows(inputfile, exportfile, use_index):
+    parselog.export_file(inputfile, str(exportfile), use_index=use_index)
+    with open(exportfile) as file:
+        rows = [json.loads(line) for line in file]
+    for row in rows:
+        row["file"] = os.path.basename(inputfile).split(".")[0]
+    return sorted(rows, key=lambda row: (row["host"], row["offset"]))
+
+
+@pytest.mark.parametrize("text", [DELEGATED_LOG, HANDLER_LOG])
+def test_export_agrees_without_the_index(tmp_path, text):
+    inputfile = write_log(tmp_path, text)
+    with gzip.open(inputfile + ".gz", "wt") as file:
+        file.write(text)
+    indexed = export_rows(inputfile, tmp_path / "indexed.jsonl", use_index=True)
+    streamed = export_rows(inputfile, tmp_path / "streamed.jsonl", use_index=False)
+    compressed = export_rows(inputfile + ".gz", tmp_path / "gz.jsonl", use_index=True)
+    assert indexed and streamed == indexed and compressed == indexed